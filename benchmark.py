@@ -0,0 +1,123 @@
+import argparse
+import configparser
+import logging
+import os
+import subprocess
+import tempfile
+import time
+from helpers.helpers import GitHelper, InputHelper, MultiBuildHelper
+
+VARIANTS = {
+    'default': {'FLATTEN': 'false', 'COMPRESSION': 'gzip'},
+    'flatten': {'FLATTEN': 'true', 'COMPRESSION': 'gzip'},
+    'zstd': {'FLATTEN': 'false', 'COMPRESSION': 'zstd'},
+    'flatten-zstd': {'FLATTEN': 'true', 'COMPRESSION': 'zstd'},
+}
+
+parser = argparse.ArgumentParser(description='Compare pull times of the layer layouts and compressions')
+parser.add_argument('--inputs', default='inputs.properties', help='Inputs file to build the benchmark image from')
+parser.add_argument('--registry', default='localhost:5000', help='Registry to push to and pull from')
+parser.add_argument('--runs', default='3', help='Number of pulls timed for each variant')
+parser.add_argument('--variants', default=','.join(VARIANTS), help='Comma separated variants to compare')
+arguments = parser.parse_args()
+
+
+def run(command):
+    """
+    Run a docker command, stopping the benchmark when it fails
+    :param command: list
+    :return: string output
+    """
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise SystemExit(f'{" ".join(command)} failed: {result.stderr.strip()}')
+
+    return result.stdout.strip()
+
+
+def start_registry(registry):
+    """
+    Start a throw away registry:2 container when nothing answers on the registry address
+    :param registry: string host:port
+    :return: None
+    """
+    probe = subprocess.run(['curl', '-sf', f'http://{registry}/v2/'], capture_output=True)
+    if probe.returncode == 0:
+        return
+
+    logging.warning(f'Starting registry:2 on {registry}')
+    run(['docker', 'run', '-d', '--rm', '--name', 'benchmark-registry', '-p', f'{registry.split(":")[-1]}:5000',
+         'registry:2'])
+    time.sleep(2)
+
+
+def write_inputs(inputs_file, variant, overrides):
+    """
+    Copy the inputs file with the build options of the variant
+    :param inputs_file: string
+    :param variant: string
+    :param overrides: dict
+    :return: string path of the copy
+    """
+    config = configparser.RawConfigParser()
+    config.optionxform = str
+    config.read(inputs_file)
+    for key_, value_ in overrides.items():
+        config.set('build_options', key_, value_)
+    variant_file = f'{tempfile.gettempdir()}{os.path.sep}benchmark-{variant}.properties'
+    with open(variant_file, 'w') as out_:
+        config.write(out_)
+
+    return variant_file
+
+
+def build_and_push(inputs_file, variant, overrides, image):
+    """
+    Generate the Dockerfile for the variant, then build and push it with docker buildx
+    :param inputs_file: string
+    :param variant: string
+    :param overrides: dict
+    :param image: string
+    :return: None
+    """
+    input_helper = InputHelper(write_inputs(inputs_file, variant, overrides), job_id=variant)
+    MultiBuildHelper(input_helper).generate()
+    GitHelper(input_helper).clone_git()
+    compression = 'compression=zstd,force-compression=true,oci-mediatypes=true' \
+        if overrides['COMPRESSION'] == 'zstd' else 'compression=gzip'
+    logging.warning(f'Building and pushing {image}')
+    run(['docker', 'buildx', 'build', '--progress=quiet',
+         '--output', f'type=image,name={image},push=true,registry.insecure=true,{compression}',
+         input_helper.get_application_build('MULTI_DIRECTORY')])
+
+
+def time_pulls(image, runs):
+    """
+    Remove the local copy and time pulling the image from the registry
+    :param image: string
+    :param runs: int
+    :return: list of seconds
+    """
+    timings = []
+    for _ in range(runs):
+        subprocess.run(['docker', 'image', 'rm', '-f', image], capture_output=True)
+        started = time.time()
+        run(['docker', 'pull', '-q', image])
+        timings.append(time.time() - started)
+
+    return timings
+
+
+start_registry(arguments.registry)
+results = []
+for variant_ in arguments.variants.split(','):
+    image_ = f'{arguments.registry}/benchmark:{variant_}'
+    build_and_push(arguments.inputs, variant_, VARIANTS[variant_], image_)
+    timings_ = time_pulls(image_, int(arguments.runs))
+    layers_ = run(['docker', 'image', 'inspect', '--format', '{{len .RootFS.Layers}}', image_])
+    size_ = int(run(['docker', 'image', 'inspect', '--format', '{{.Size}}', image_]))
+    results.append((variant_, layers_, size_ // (1024 * 1024), sum(timings_) / len(timings_), min(timings_)))
+
+print(f'{"variant":<14}{"layers":>8}{"size MB":>10}{"mean pull s":>14}{"best pull s":>14}')
+for variant_, layers_, size_, mean_, best_ in results:
+    print(f'{variant_:<14}{layers_:>8}{size_:>10}{mean_:>14.2f}{best_:>14.2f}')
@@ -0,0 +1,36 @@
+import argparse
+import datetime
+from distutils.util import strtobool
+import logging
+import sys
+from helpers.helpers import InputHelper, MatrixHelper
+
+parser = argparse.ArgumentParser()
+parser.add_argument('inputs', nargs='*', help='Inputs files to build, defaults to INPUTS in the matrix section')
+parser.add_argument('--matrix', default='inputs.properties', help='File with the matrix section')
+parser.add_argument('--workers', help='Number of builds to run at the same time')
+parser.add_argument('--upload', help='Boolean to determine if builds should be published to registry')
+parser.add_argument('--hosts', help='Comma delimited docker hosts to spread the builds over')
+arguments = parser.parse_args()
+do_upload = False
+if arguments.upload:
+    do_upload = strtobool(arguments.upload)
+
+logging.basicConfig(format='%(levelname)s:%(threadName)s:%(message)s')
+START = datetime.datetime.now()
+logging.warning(f'Starting at {START}')
+MATRIX = InputHelper(arguments.matrix)
+INPUTS_FILES = arguments.inputs
+if not INPUTS_FILES:
+    INPUTS_FILES = [f_.strip() for f_ in MATRIX.get_matrix('INPUTS', '').split(',') if f_.strip()]
+if not INPUTS_FILES:
+    sys.exit('No inputs files to build')
+WORKERS = int(arguments.workers or MATRIX.get_matrix('MAX_WORKERS', '2'))
+DOCKER_HOSTS = [h_.strip() for h_ in (arguments.hosts or MATRIX.get_matrix('DOCKER_HOSTS', '')).split(',') if h_.strip()]
+RESULTS = MatrixHelper(INPUTS_FILES, max_workers=WORKERS, upload=do_upload, docker_hosts=DOCKER_HOSTS,
+                       jobs_per_host=int(MATRIX.get_matrix('JOBS_PER_HOST', '2')),
+                       host_retries=int(MATRIX.get_matrix('HOST_RETRIES', '1'))).run()
+END = datetime.datetime.now()
+logging.warning(f'Completed at {END} in {END - START}')
+if None in RESULTS.values():
+    sys.exit(f'Failed builds: {[f_ for f_, t_ in RESULTS.items() if t_ is None]}')
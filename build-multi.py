@@ -2,29 +2,33 @@ import argparse
 import datetime
 from distutils.util import strtobool
 import logging
-from helpers.helpers import InputHelper, DockerHelper, EcrHelper, GitHelper
+from helpers.helpers import InputHelper, MultiBuildHelper
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--upload', help='Boolean to determine if build should be published to registry')
+parser.add_argument('--prune', help='Boolean to determine if all local containers, images and networks are pruned')
+parser.add_argument('--update-lock', help='Boolean to determine if pinned parent images are resolved again')
+parser.add_argument('--generate-only', help='Boolean to determine if only the Dockerfile is generated, nothing is built')
 arguments = parser.parse_args()
 do_upload = False
+do_prune = False
+do_update_lock = False
+generate_only = False
 if arguments.upload:
     do_upload = strtobool(arguments.upload)
+if arguments.prune:
+    do_prune = strtobool(arguments.prune)
+if arguments.update_lock:
+    do_update_lock = strtobool(arguments.update_lock)
+if arguments.generate_only:
+    generate_only = strtobool(arguments.generate_only)
 
 START = datetime.datetime.now()
 logging.warning(f'Starting at {START}')
 INPUTS = InputHelper('inputs.properties')
-DOCKER_BUILD = DockerHelper(INPUTS)
-DOCKER_BUILD.create_multi_docker_file()
-GIT = GitHelper(INPUTS)
-GIT.clone_git()
-AWS_ECR = EcrHelper(INPUTS)
-DOCKER_BUILD.set_repository_uri(AWS_ECR.get_repository_uri())
-DOCKER_BUILD.set_application_version_next(AWS_ECR.get_application_version_next())
-DOCKER_BUILD.set_docker_env(AWS_ECR.get_docker_env())
-DOCKER_BUILD.set_network(AWS_ECR.get_network())
-BUILD_TAG = DOCKER_BUILD.build_multi_docker_image()
-if do_upload:
-    AWS_ECR.registry_upload(BUILD_TAG)
+if generate_only:
+    MultiBuildHelper(INPUTS).generate()
+else:
+    BUILD_TAG = MultiBuildHelper(INPUTS, upload=do_upload, prune=do_prune, update_lock=do_update_lock).run()
 END = datetime.datetime.now()
 logging.warning(f'Completed at {END} in {END - START}')
@@ -2,35 +2,80 @@ import argparse
 import datetime
 from distutils.util import strtobool
 import logging
-from helpers.helpers import InputHelper, DockerHelper, EcrHelper, GitHelper
+import sys
+from helpers.helpers import InputHelper, DockerHelper, EcrHelper, GitHelper, MetricsHelper, ParentPinHelper, WatchHelper
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--upload', help='Boolean to determine if build should be published to registry')
+parser.add_argument('--prune', help='Boolean to determine if all local containers, images and networks are pruned')
 parser.add_argument('--clone', help='Boolean to determine if code should be cloned')
+parser.add_argument('--update-lock', help='Boolean to determine if pinned parent images are resolved again')
+parser.add_argument('--generate-only', help='Boolean to determine if only the Dockerfile is generated, nothing is built')
+parser.add_argument('--watch', help='Boolean to determine if the image is rebuilt whenever an input changes')
 arguments = parser.parse_args()
 do_upload = False
+do_prune = False
 clone = False
+do_update_lock = False
+generate_only = False
+watch = False
 if arguments.upload:
     do_upload = strtobool(arguments.upload)
+if arguments.prune:
+    do_prune = strtobool(arguments.prune)
 if arguments.clone:
     clone = strtobool(arguments.clone)
+if arguments.update_lock:
+    do_update_lock = strtobool(arguments.update_lock)
+if arguments.generate_only:
+    generate_only = strtobool(arguments.generate_only)
+if arguments.watch:
+    watch = strtobool(arguments.watch)
 
 TYPE = 'build'
 START = datetime.datetime.now()
 logging.warning(f'Starting at {START}')
+if watch:
+    WatchHelper('inputs.properties', TYPE, upload=do_upload, prune=do_prune, clone=clone,
+                update_lock=do_update_lock).run()
+    sys.exit()
 INPUTS = InputHelper('inputs.properties')
+METRICS = MetricsHelper(INPUTS)
 DOCKER_BUILD = DockerHelper(INPUTS)
-DOCKER_BUILD.create_docker_file(TYPE)
-GIT = GitHelper(INPUTS)
-if clone:
-    GIT.clone_git()
-AWS_ECR = EcrHelper(INPUTS)
-DOCKER_BUILD.set_repository_uri(AWS_ECR.get_repository_uri())
-DOCKER_BUILD.set_application_version_next(AWS_ECR.get_application_version_next())
-DOCKER_BUILD.set_docker_env(AWS_ECR.get_docker_env())
-DOCKER_BUILD.set_network(AWS_ECR.get_network())
-BUILD_TAG = DOCKER_BUILD.build_docker_image(TYPE)
-if do_upload:
-    AWS_ECR.registry_upload(BUILD_TAG)
+PARENTS = None
+if strtobool(INPUTS.get_build_options('PIN_PARENTS', 'false')):
+    PARENTS = ParentPinHelper(INPUTS, update=do_update_lock)
+    DOCKER_BUILD.set_parent_pins(METRICS.timed('parents', lambda: PARENTS.pin(resolve=not generate_only)))
+    if not generate_only:
+        PARENTS.pull()
+METRICS.timed('generate', lambda: DOCKER_BUILD.create_docker_file(TYPE))
+if not generate_only:
+    BUILD_TAG = None
+    try:
+        GIT = GitHelper(INPUTS)
+        if clone:
+            METRICS.timed('clone', GIT.clone_git)
+        AWS_ECR = METRICS.timed('ecr', lambda: EcrHelper(INPUTS, prune=do_prune))
+        METRICS.add_phases(AWS_ECR.get_phase_timings(), prefix='ecr_')
+        DOCKER_BUILD.set_repository_uri(AWS_ECR.get_repository_uri())
+        DOCKER_BUILD.set_application_version_next(AWS_ECR.get_application_version_next())
+        DOCKER_BUILD.set_docker_env(AWS_ECR.get_docker_env())
+        DOCKER_BUILD.set_network(AWS_ECR.get_network())
+        DOCKER_BUILD.set_image_cache(AWS_ECR.get_image_cache())
+        if PARENTS:
+            METRICS.timed('parents_pull', PARENTS.wait)
+        PUSH_FROM_BUILD = do_upload and DOCKER_BUILD.uses_zstd()
+        if PUSH_FROM_BUILD:
+            AWS_ECR.registry_login_cli()
+        BUILD_TAG = METRICS.timed('build', lambda: DOCKER_BUILD.build_docker_image(TYPE, push=PUSH_FROM_BUILD))
+        METRICS.set_build(DOCKER_BUILD)
+        if do_upload:
+            METRICS.add_push(METRICS.timed('push', lambda: AWS_ECR.registry_upload(
+                BUILD_TAG, pushed=DOCKER_BUILD.get_buildx_push())))
+    except BaseException:
+        METRICS.set_build(DOCKER_BUILD)
+        METRICS.write(BUILD_TAG, succeeded=False)
+        raise
+    METRICS.write(BUILD_TAG, succeeded=True)
 END = datetime.datetime.now()
 logging.warning(f'Completed at {END} in {END - START}')
@@ -1,13 +1,30 @@
 import base64
-import boto3
-import docker
+import hashlib
+import json
 import logging
 import os
+import posixpath
+import urllib.request
 import sys
 import shutil
+import socket
 import configparser
-from git import Repo
-from docker.errors import BuildError
+import datetime
+import re
+import shlex
+import subprocess
+import tarfile
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from distutils.util import strtobool
+
+# boto3, docker and GitPython are imported by the methods that use them,
+# generating a Dockerfile does not need them and they are slow to import
+
+ITEM_MARKER = '# item: '
+BUILDKIT_SYNTAX = '# syntax=docker/dockerfile:1\n'
 
 
 class InputHelper:
@@ -16,10 +33,34 @@ class InputHelper:
     """
 
     __config = None
+    __job_id = None
+    __docker_host = None
 
-    def __init__(self, inputs_file_name):
+    def __init__(self, inputs_file_name, job_id=None, docker_host=None):
         self.__config = configparser.RawConfigParser()
         self.__config.read(inputs_file_name)
+        self.__job_id = job_id
+        self.__docker_host = docker_host
+        if job_id:
+            self.__isolate__(job_id)
+
+    def __isolate__(self, job_id):
+        """
+        Suffix the build directories and network name with the job id so builds can run side by side
+        :param job_id: string
+        :return: None
+        """
+        for section, key in [('application_image', 'DIRECTORY'),
+                             ('application_image', 'NETWORK_NAME'),
+                             ('application_build', 'DIRECTORY'),
+                             ('application_build', 'MULTI_DIRECTORY')]:
+            self.__config.set(section, key, f'{self.__config.get(section, key)}_{job_id}')
+
+    def get_job_id(self):
+        return self.__job_id
+
+    def get_docker_host(self):
+        return self.__docker_host
 
     def get_application(self, key):
         """
@@ -45,13 +86,52 @@ class InputHelper:
         """
         return self.__config.get('application_build', key)
 
-    def get_ecr_repository(self, key):
+    def get_ecr_repository(self, key, default=None):
         """
         Get parameter from ecr_repository section
         :param key: string
+        :param default: string returned when key is missing, when not set the key is required
+        :return: string
+        """
+        if default is None:
+            return self.__config.get('ecr_repository', key)
+
+        return self.__config.get('ecr_repository', key, fallback=default)
+
+    def get_build_cache(self, key, default=None):
+        """
+        Get optional parameter from build_cache section
+        :param key: string
+        :param default: string returned when section or key is missing
+        :return: string
+        """
+        return self.__config.get('build_cache', key, fallback=default)
+
+    def get_build_options(self, key, default=None):
+        """
+        Get optional parameter from build_options section
+        :param key: string
+        :param default: string returned when section or key is missing
+        :return: string
+        """
+        return self.__config.get('build_options', key, fallback=default)
+
+    def get_matrix(self, key, default=None):
+        """
+        Get optional parameter from matrix section
+        :param key: string
+        :param default: string returned when section or key is missing
         :return: string
         """
-        return self.__config.get('ecr_repository', key)
+        return self.__config.get('matrix', key, fallback=default)
+
+    def get_sections(self):
+        """
+        Get every parameter of every section
+        :return: dict of section to dict of upper case key to value
+        """
+        return {section_: {key_.upper(): value_ for key_, value_ in self.__config.items(section_)}
+                for section_ in self.__config.sections()}
 
 
 class DockerHelper:
@@ -75,6 +155,36 @@ class DockerHelper:
     __multi_build_folder = None
     __network = None
     __timezone = None
+    __git_commit = None
+    __build_hash = None
+    __image_cache = None
+    __optimize = False
+    __staging = None
+    __context_include = None
+    __buildkit = False
+    __artifact_store = None
+    __artifact_key = None
+    __artifact_commit = None
+    __artifacts_stored = False
+    __parent_pins = None
+    __catalog = None
+    __tokens = None
+    __history = None
+    __order = None
+    __image_size = None
+    __flatten = False
+    __compression = None
+    __oci_export = False
+    __buildx_builder = None
+    __buildx_outputs = None
+    __buildx_push = None
+    __cancel = None
+    __build_process = None
+    __build_response = None
+    __docker_host = None
+    __build_report = None
+    __build_base = None
+    __size_report = None
 
     def __init__(self, input_helper):
         self.__application_name = input_helper.get_application('NAME')
@@ -92,9 +202,33 @@ class DockerHelper:
         self.__exec_options = input_helper.get_application_build('EXEC_OPTIONS')
         self.__build_artifacts = input_helper.get_application_build('ARTIFACTS')
         self.__multi_build_folder = input_helper.get_application_build('MULTI_DIRECTORY')
-        self.__reset_docker_folder__(self.__multi_build_folder)
-        self.__reset_docker_folder__(self.__build_directory)
-        self.__reset_docker_folder__(self.__application_directory)
+        self.__optimize = strtobool(input_helper.get_build_options('OPTIMIZE', 'false'))
+        self.__buildkit = strtobool(input_helper.get_build_options('BUILDKIT', 'false'))
+        if strtobool(input_helper.get_build_options('ARTIFACT_STORE', 'false')):
+            cache_directory = input_helper.get_build_cache('DIRECTORY', '.build_cache')
+            self.__artifact_store = f'{cache_directory}{os.path.sep}artifacts'
+        self.__context_include = input_helper.get_build_options('CONTEXT_INCLUDE', '')
+        self.__flatten = strtobool(input_helper.get_build_options('FLATTEN', 'false'))
+        self.__compression = input_helper.get_build_options('COMPRESSION', 'gzip')
+        if self.__compression not in ('gzip', 'zstd'):
+            sys.exit(f'COMPRESSION must be gzip or zstd, not {self.__compression}')
+        self.__oci_export = strtobool(input_helper.get_build_options('OCI_EXPORT', 'false'))
+        self.__buildx_builder = input_helper.get_build_options('BUILDX_BUILDER', '')
+        self.__parent_pins = {}
+        self.__docker_host = input_helper.get_docker_host()
+        self.__cancel = threading.Event()
+        self.__catalog = CatalogHelper(input_helper)
+        self.__tokens = TokenHelper(input_helper)
+        self.__history = ItemHistoryHelper(input_helper)
+        self.__image_size = ImageSizeHelper(input_helper)
+        self.__order = input_helper.get_build_options('ORDER', 'selected')
+        if self.__order not in ('selected', 'cache'):
+            sys.exit(f'ORDER must be selected or cache, not {self.__order}')
+        link = input_helper.get_build_options('STAGING', 'copy') == 'link'
+        self.__staging = {directory_: StagingHelper(directory_, link=link)
+                          for directory_ in [self.__multi_build_folder,
+                                             self.__build_directory,
+                                             self.__application_directory]}
 
     def create_multi_docker_file(self):
         """
@@ -103,82 +237,145 @@ class DockerHelper:
         """
         new_docker_file = []
         current_directory = self.__multi_build_folder
+        self.__build_hash = None
         code_items = self.__input_to_list__(self.__build_items)
         app_items = self.__input_to_list__(self.__application_items)
 
         if self.__build_parent == self.__application_parent:
             base_name = self.__get_base_name__(self.__build_parent)
+            code_parent = self.__from__(self.__build_parent)
+            app_parent = self.__from__(self.__application_parent)
+
+            code_items, app_items = self.__order_items__([code_items, app_items], base_name)
+            self.__check_requires__(code_items, base_name)
+            self.__check_requires__(app_items, base_name)
+            # Flattening builds every application item in the A stage so none are left in BASE layers
+            shared_items = [] if self.__flatten else self.__shared_prefix__(code_items, app_items)
+            if shared_items:
+                logging.warning(f'Adding shared items {shared_items} once to BASE stage')
+                new_docker_file.append(f'FROM {self.__from__(self.__build_parent)} as BASE\n')
+                new_docker_file.extend(self.__read_items__(shared_items, base_name, current_directory))
+                new_docker_file.append('\n')
+                code_parent = 'BASE'
+                app_parent = 'BASE'
 
             if code_items:
-                new_docker_file.append(f'FROM {self.__build_parent} as B\n')
-                for ci in code_items:
-                    working_directory = f'{os.getcwd()}{os.path.sep}{ci}{os.path.sep}{base_name}'
-                    if self.__path_exists__(working_directory):
-                        working_directory_contents = self.__get_directory_contents__(working_directory)
-                        if working_directory_contents:
-                            found_docker = False
-                            for file_ in working_directory_contents:
-                                if 'Dockerfile' in file_:
-                                    found_docker = True
-                                    logging.warning(f'Adding contents to {current_directory}/Dockerfile from {file_}')
-                                    with open(file_, 'r') as in_:
-                                        in_lines = in_.readlines()
-                                        if in_lines:
-                                            new_docker_file.extend(self.__update_tokens__(in_lines))
-                                        else:
-                                            sys.exit(f'{file_} has no content.')
-                                else:
-                                    shutil.copy(file_, f'{current_directory}{os.path.sep}')
-
-                            if not found_docker:
-                                sys.exit(f'{working_directory} is missing Dockerfile')
-
-                        else:
-                            sys.exit(f'{working_directory} was empty')
-
-                new_docker_file.append('\n')
+                build_stage = [f'FROM {code_parent} as B\n']
+                build_stage.extend(self.__read_items__(code_items[len(shared_items):], base_name,
+                                                       current_directory))
+                build_stage.append('\n')
+                self.__artifacts_stored = self.__find_artifacts__(new_docker_file + build_stage)
+                if not self.__artifacts_stored:
+                    new_docker_file.extend(build_stage)
 
             if app_items:
-                new_docker_file.append(f'FROM {self.__application_parent} as A\n')
-                for ai in app_items:
-                    working_directory = f'{os.getcwd()}{os.path.sep}{ai}{os.path.sep}{base_name}'
-                    if self.__path_exists__(working_directory):
-                        working_directory_contents = self.__get_directory_contents__(working_directory)
-                        if working_directory_contents:
-                            found_docker = False
-                            for file_ in working_directory_contents:
-                                if 'Dockerfile' in file_:
-                                    found_docker = True
-                                    logging.warning(f'Adding contents to {current_directory}/Dockerfile from {file_}')
-                                    with open(file_, 'r') as in_:
-                                        in_lines = in_.readlines()
-                                        if in_lines:
-                                            new_docker_file.extend(self.__update_tokens__(in_lines))
-                                        else:
-                                            sys.exit(f'{file_} has no content.')
-                                else:
-                                    shutil.copy(file_, f'{current_directory}{os.path.sep}')
-
-                            if not found_docker:
-                                sys.exit(f'{working_directory} is missing Dockerfile')
-
-                        else:
-                            sys.exit(f'{working_directory} was empty')
-
+                new_docker_file.append(f'FROM {app_parent} as A\n')
+                new_docker_file.extend(self.__read_items__(app_items[len(shared_items):], base_name,
+                                                           current_directory, flatten=self.__flatten))
                 new_docker_file.append('\n')
         else:
             sys.exit(f'You cannot build code with {self.__build_parent} '
                      f'and build application with {self.__application_parent} '
                      f'they have to be the same.')
 
+        self.__check_tokens__()
         if new_docker_file:
-            new_docker_file.append(f'COPY --from=B '
-                                   f'/code/{self.__build_artifacts}/ /opt/code/ \n')
-            with open(f'{current_directory}/Dockerfile', 'w') as out_:
-                out_.writelines(new_docker_file)
+            if self.__buildkit:
+                new_docker_file.insert(0, BUILDKIT_SYNTAX)
+            new_docker_file.append(f'{ITEM_MARKER}artifacts\n')
+            if self.__artifacts_stored:
+                new_docker_file.append(f'COPY {self.__stage_artifacts__(current_directory)}/ /opt/code/ \n')
+            else:
+                new_docker_file.append(f'COPY --from=B '
+                                       f'/code/{self.__build_artifacts}/ /opt/code/ \n')
+            self.__staging.get(current_directory).write('Dockerfile', new_docker_file)
+            self.__write_docker_ignore__(current_directory, new_docker_file)
+
+        self.__staging.get(current_directory).finish()
 
         return new_docker_file
 
+    def __find_artifacts__(self, build_lines):
+        """
+        Work out the artifact key from the url, commit, build settings and the lines of the build
+        stages, then check if the artifact store already has artifacts for it
+        :param build_lines: list
+        :return: bool
+        """
+        self.__artifact_key = None
+        if not self.__artifact_store or not self.__git_commit:
+            return False
+
+        artifact_hash = hashlib.sha256()
+        for value in [self.__git_url, self.__git_commit, self.__build_folder,
+                      self.__exec_command, self.__exec_options, self.__build_artifacts]:
+            artifact_hash.update(f'{value}\n'.encode('utf-8'))
+        artifact_hash.update(''.join(build_lines).encode('utf-8'))
+        self.__artifact_key = artifact_hash.hexdigest()
+        self.__artifact_commit = self.__git_commit
+        if os.path.isdir(f'{self.__artifact_store}{os.path.sep}{self.__artifact_key}'):
+            logging.warning(f'Artifacts for {self.__git_commit} already built, skipping the build stage')
+            return True
+
+        return False
+
+    def __stage_artifacts__(self, current_directory):
+        """
+        Stage stored artifacts into the build directory
+        :param current_directory: string
+        :return: string folder name in the build directory
+        """
+        stored_folder = f'{self.__artifact_store}{os.path.sep}{self.__artifact_key}'
+        for (root, dirs, files) in os.walk(stored_folder):
+            for f_ in files:
+                relative_path = os.path.relpath(os.path.join(root, f_), stored_folder)
+                self.__staging.get(current_directory).stage(os.path.join(root, f_),
+                                                            f'artifacts{os.path.sep}{relative_path}')
+
+        return 'artifacts'
+
+    def has_stored_artifacts(self):
+        return self.__artifacts_stored
+
+    def uses_artifact_store(self):
+        return self.__artifact_store is not None
+
+    def store_artifacts(self, image_tag):
+        """
+        Copy /opt/code out of the built image into the artifact store so the next build of the
+        same commit can skip the build stage
+        :param image_tag: string
+        :return: bool
+        """
+        if not self.__artifact_key or self.__artifacts_stored:
+            return False
+        if self.__git_commit != self.__artifact_commit:
+            logging.warning(f'Cloned {self.__git_commit} but expected {self.__artifact_commit}, not storing artifacts')
+            return False
+
+        stored_folder = f'{self.__artifact_store}{os.path.sep}{self.__artifact_key}'
+        os.makedirs(self.__artifact_store, exist_ok=True)
+        container = self.__docker_env.containers.create(image_tag)
+        try:
+            bits, stat_ = container.get_archive('/opt/code')
+            with tempfile.TemporaryDirectory(dir=self.__artifact_store) as temporary_:
+                with tempfile.TemporaryFile() as archive_:
+                    for chunk in bits:
+                        archive_.write(chunk)
+                    archive_.seek(0)
+                    with tarfile.open(fileobj=archive_) as tar_:
+                        if hasattr(tarfile, 'data_filter'):
+                            tar_.extractall(temporary_, filter='data')
+                        else:
+                            tar_.extractall(temporary_)
+                os.replace(f'{temporary_}{os.path.sep}code', stored_folder)
+        finally:
+            container.remove()
+
+        logging.warning(f'Stored artifacts of {self.__artifact_commit} in {stored_folder}')
+        self.__artifacts_stored = True
+        return True
+
     def create_docker_file(self, image_type):
         """
         Create docker file in appropriate directory
@@ -191,132 +388,642 @@ class DockerHelper:
             current_name = self.__application_parent
             current_items = self.__application_items
             current_directory = self.__application_directory
-            new_docker_file.append(f'FROM {current_name}\n')
+            new_docker_file.append(f'FROM {self.__from__(current_name)}\n')
         elif image_type == 'build':
             current_name = self.__build_parent
             current_items = self.__build_items
             current_directory = self.__build_directory
-            new_docker_file.append(f'FROM {current_name}\n')
+            new_docker_file.append(f'FROM {self.__from__(current_name)}\n')
         else:
             sys.exit(f'You must only choose application or build for image_type')
 
         selected_items_list = self.__input_to_list__(current_items)
         base_name = self.__get_base_name__(current_name)
-        for selected_ in selected_items_list:
-            working_directory = f'{os.getcwd()}{os.path.sep}{selected_}{os.path.sep}{base_name}'
-            if self.__path_exists__(working_directory):
-                working_directory_contents = self.__get_directory_contents__(working_directory)
-                if working_directory_contents:
-                    found_docker = False
-                    for file_ in working_directory_contents:
-                        if 'Dockerfile' in file_:
-                            found_docker = True
-                            logging.warning(f'Adding contents to {current_directory}/Dockerfile from {file_}')
-                            with open(file_, 'r') as in_:
-                                in_lines = in_.readlines()
-                                if in_lines:
-                                    new_docker_file.extend(self.__update_tokens__(in_lines))
-                                else:
-                                    sys.exit(f'{file_} has no content.')
-                        else:
-                            shutil.copy(file_, f'{current_directory}{os.path.sep}')
+        selected_items_list = self.__order_items__([selected_items_list], base_name)[0]
+        self.__check_requires__(selected_items_list, base_name)
+        new_docker_file.extend(self.__read_items__(selected_items_list, base_name, current_directory,
+                                                   flatten=self.__flatten and image_type == 'application'))
+        self.__check_tokens__()
+        if self.__buildkit:
+            new_docker_file.insert(0, BUILDKIT_SYNTAX)
+        self.__staging.get(current_directory).write('Dockerfile', new_docker_file)
+        self.__write_docker_ignore__(current_directory, new_docker_file)
+        self.__staging.get(current_directory).finish()
 
-                    if found_docker:
-                        with open(f'{current_directory}{os.path.sep}Dockerfile', 'w') as out_:
-                            out_.writelines(new_docker_file)
+        return new_docker_file
 
-                    else:
-                        sys.exit(f'{working_directory} is missing Dockerfile')
+    def __from__(self, parent_name):
+        """
+        Parent to use in a FROM instruction, pinned to a digest when one is known
+        :param parent_name: string
+        :return: string
+        """
+        return self.__parent_pins.get(parent_name, parent_name)
 
+    def __write_docker_ignore__(self, current_directory, docker_file):
+        """
+        Write a .dockerignore that only lets through what the Dockerfile uses: the files items copy,
+        the files at the root of the cloned code, its BUILD_FOLDER, the gradle wrapper and anything
+        in CONTEXT_INCLUDE.
+        Git metadata and previously built ARTIFACTS are never sent.
+        :param current_directory: string
+        :param docker_file: list
+        :return: list
+        """
+        ignore_lines = ['# Generated, only what the Dockerfile needs is sent to docker\n', '*\n', '!Dockerfile\n']
+        uses_code = False
+        for instruction, arguments, items in DockerfileOptimizer.parse_instructions(docker_file):
+            if instruction not in ('COPY', 'ADD'):
+                continue
+            sources = [a_ for a_ in arguments.split() if not a_.startswith('--')][:-1]
+            if any(a_.startswith('--from') for a_ in arguments.split()):
+                continue
+            for source in sources:
+                if source.strip('./') == 'code':
+                    uses_code = True
                 else:
-                    sys.exit(f'{working_directory} was empty')
+                    ignore_lines.append(f'!{source}\n')
 
-        return new_docker_file
+        if uses_code:
+            build_folder = self.__build_folder.strip('/')
+            if build_folder in ('', '.'):
+                ignore_lines.append('!code\n')
+            else:
+                # Files at the root of the repository, such as settings.gradle and gradle.properties, are
+                # sent like a sparse checkout keeps them, folders other than BUILD_FOLDER are not
+                ignore_lines.extend(['!code/*\n', 'code/*/**\n', f'!code/{build_folder}\n'])
+            if 'gradlew' in self.__exec_command:
+                exec_folder = os.path.dirname(self.__exec_command.strip('/'))
+                exec_prefix = f'code/{exec_folder}/' if exec_folder else 'code/'
+                ignore_lines.extend([f'!{exec_prefix}gradlew\n', f'!{exec_prefix}gradle/wrapper\n'])
+            elif '/' in self.__exec_command:
+                ignore_lines.append(f'!code/{self.__exec_command.strip("/")}\n')
+            for include_ in self.__input_to_list__(self.__context_include):
+                if include_:
+                    ignore_lines.append(f'!code/{include_.strip("/")}\n')
+            ignore_lines.append(f'code/{self.__build_artifacts.strip("/")}\n')
+            ignore_lines.append('code/**/.git\n')
+
+        self.__staging.get(current_directory).write('.dockerignore', ignore_lines)
+        return ignore_lines
 
-    def __update_tokens__(self, lines):
+    @staticmethod
+    def __get_context_size__(current_directory):
         """
-        Replace any tokens in file
-        :param lines: list
+        Count the files and bytes docker will be sent after applying .dockerignore
+        :param current_directory: string
+        :return: dict
+        """
+        from docker.utils.build import exclude_paths
+
+        patterns = []
+        ignore_file = f'{current_directory}{os.path.sep}.dockerignore'
+        if os.path.exists(ignore_file):
+            with open(ignore_file, 'r') as in_:
+                patterns = [l_.strip() for l_ in in_.read().splitlines() if l_.strip() and not l_.startswith('#')]
+
+        context = {'files': 0, 'bytes': 0}
+        for path_ in exclude_paths(current_directory, patterns):
+            full_path = os.path.join(current_directory, path_)
+            if os.path.isfile(full_path):
+                context['files'] += 1
+                context['bytes'] += os.path.getsize(full_path)
+
+        logging.warning(f'Sending {context["files"]} files, {round(context["bytes"] / (1024 * 1024), 2)}MB '
+                        f'of context from {current_directory}')
+        return context
+
+    def __read_items__(self, items, base_name, current_directory, flatten=False):
+        """
+        Read the Dockerfile of each selected item for the base image, copying any other files
+        into the build directory, and return the lines for one stage
+        :param items: list
+        :param base_name: string
+        :param current_directory: string
+        :param flatten: bool flatten the stage into a fixed number of layers
         :return: list
         """
-        updated_lines = []
-        for line in lines:
-            if '@' in line:
-                temp_line = line
-                temp_line = temp_line.replace('@URL@', self.__git_url)
-                temp_line = temp_line.replace('@BRANCH@', self.__git_branch)
-                temp_line = temp_line.replace('@FOLDER@', self.__build_folder)
-                temp_line = temp_line.replace('@TIMEZONE@', self.__timezone)
-                if 'gradlew' in self.__exec_command:
-                    temp_line = temp_line.replace('@EXEC@', f'/code/{self.__exec_command}')
+        stage_lines = []
+        for item_ in items:
+            entry = self.__catalog.get(item_, base_name)
+            base_folder = self.__catalog.get_base_folder(entry)
+            file_ = f'{base_folder}{os.path.sep}Dockerfile'
+            logging.warning(f'Adding contents to {current_directory}/Dockerfile from {file_}')
+            with open(file_, 'r') as in_:
+                in_lines = in_.readlines()
+                if in_lines:
+                    if not in_lines[-1].endswith('\n'):
+                        in_lines[-1] = f'{in_lines[-1]}\n'
+                    stage_lines.append(f'{ITEM_MARKER}{item_}\n')
+                    stage_lines.extend(self.__tokens.replace(in_lines, entry.get('dockerfile')))
                 else:
-                    temp_line = temp_line.replace('@EXEC@', {self.__exec_command})
-                temp_line = temp_line.replace('@OPTS@', self.__exec_options)
-                updated_lines.append(temp_line)
-            else:
-                updated_lines.append(line)
+                    sys.exit(f'{file_} has no content.')
 
-        return updated_lines
+            for asset_ in entry.get('assets'):
+                self.__staging.get(current_directory).stage(f'{base_folder}{os.path.sep}{asset_}', asset_)
+
+        optimizer = DockerfileOptimizer(base_name, clean=not self.__buildkit)
+        if flatten:
+            stage_lines = optimizer.flatten(stage_lines, {item_: self.__catalog.get(item_, base_name).get('requires')
+                                                          for item_ in items})
+        elif self.__optimize:
+            stage_lines = optimizer.optimize(stage_lines)
+        if self.__buildkit:
+            cache_id = re.sub(r'[^A-Za-z0-9_.-]', '-', self.__build_parent)
+            stage_lines = optimizer.add_cache_mounts(stage_lines, cache_id)
+
+        return stage_lines
 
-    def build_multi_docker_image(self):
+    def __order_items__(self, item_lists, base_name):
+        """
+        With ORDER=cache record the content of the selected items in the history and put them in the
+        order that keeps the most layers cached. Every list is ordered the same way so items shared by
+        stages stay in the same order.
+        :param item_lists: list of lists
+        :param base_name: string
+        :return: list of lists
+        """
+        if self.__order != 'cache':
+            return item_lists
+
+        entries = {}
+        for list_ in item_lists:
+            for item_ in list_:
+                entries[item_] = self.__catalog.get(item_, base_name)
+        self.__history.record_generation({item_: entry_.get('hash') for item_, entry_ in entries.items()},
+                                         base_name)
+        shared = [i_ for i_ in entries if all(i_ in list_ for list_ in item_lists)]
+        ordered = self.__history.order(list(entries), {item_: entry_.get('requires')
+                                                       for item_, entry_ in entries.items()}, base_name, shared)
+        ordered_lists = [[i_ for i_ in ordered if i_ in list_] for list_ in item_lists]
+        for list_, ordered_list_ in zip(item_lists, ordered_lists):
+            if list_ != ordered_list_:
+                logging.warning(f'Ordered {",".join(list_)} as {",".join(ordered_list_)} for the layer cache')
+
+        return ordered_lists
+
+    def __check_requires__(self, items, base_name):
+        """
+        Warn about items whose declared dependencies are not selected before them
+        :param items: list
+        :param base_name: string
+        :return: list of missing (item, requires)
+        """
+        missing = []
+        for index, item_ in enumerate(items):
+            for requires_ in self.__catalog.get(item_, base_name).get('requires'):
+                if requires_ not in items[:index]:
+                    logging.warning(f'{item_} requires {requires_} which is not selected before it')
+                    missing.append((item_, requires_))
+
+        return missing
+
+    def __check_tokens__(self):
+        """
+        Stop before anything is written or built when items use tokens that have no value
+        :return: None
+        """
+        unknown = self.__tokens.get_unknown()
+        if unknown:
+            sys.exit('Unknown tokens, add them to the tokens section of the inputs file: ' +
+                     ', '.join(f'@{t_}@ in {", ".join(sources_)}' for t_, sources_ in sorted(unknown.items())))
+
+    def build_multi_docker_image(self, push=False):
         """
         Build the multi stage docker file and include artifacts from one build into final image
         without any of the build requirements
+        :param push: bool push from the build itself, used for zstd layers, the cli must be logged in
         :return: string
         """
         current_directory = self.__multi_build_folder
         image_tag = f'{self.__repository_uri}:{self.__application_name}-{self.__application_version_next}'
-        logging.warning(f'Building {current_directory}/Dockerfile with tag {image_tag}')
-        try:
-            results = self.__docker_env.images.build(
-                path=current_directory,
-                tag=image_tag,
-                quiet=False,
-                labels={'Application': self.__application_name,
-                        'ApplicationVersion': f'{round(self.__application_version_next, 4)}'},
-                timeout=120,
-                network_mode=self.__network.name,
-            )
-            logging.warning(f'Completed build of id {results[0].id}')
-        except BuildError as be:
-            bi = iter(be.build_log)
-            while True:
-                try:
-                    i = next(bi)
-                    logging.warning(i)
-                except StopIteration:
-                    break
-            sys.exit(bi)
+        labels = {'Application': self.__application_name,
+                  'ApplicationVersion': f'{self.__application_version_next}',
+                  'BuildHash': self.get_build_hash()}
+        self.__set_buildx_outputs__(current_directory, image_tag, push)
+        self.__build_base = self.__get_base_name__(self.__build_parent)
+        # A cached image can not be exported or pushed with zstd layers without building it again
+        cached_image = None if self.__buildx_outputs else self.find_cached_image()
+        if cached_image:
+            logging.warning(f'Build hash {self.get_build_hash()} matched image {cached_image.id}, tagging as {image_tag}')
+            cached_image.tag(image_tag)
+            self.__touch_image__(cached_image.id)
+            return image_tag
 
+        logging.warning(f'Building {current_directory}/Dockerfile with tag {image_tag}')
+        image_id = self.__stream_build__(
+            current_directory,
+            image_tag,
+            labels=labels,
+            network_mode=self.__network.name,
+        )
+        logging.warning(f'Completed build of id {image_id}')
+        self.__touch_image__(image_id)
+        self.__size_report = self.__image_size.analyze(self.__docker_env, image_id, current_directory)
+        self.store_artifacts(image_tag)
         return image_tag
 
-    def build_docker_image(self, image_type):
+    def build_docker_image(self, image_type, push=False):
         """
         Build the image using customized dockerfile
         :param image_type: string only (application|build)
+        :param push: bool push from the build itself, used for zstd layers, the cli must be logged in
         :return: string image_name
         """
 
         if image_type == 'application':
             current_directory = self.__application_directory
             image_tag = f'{self.__repository_uri}:{self.__application_name}-{self.__application_version_next}'
+            self.__build_base = self.__get_base_name__(self.__application_parent)
         elif image_type == 'build':
             current_directory = self.__build_directory
             image_tag = f'{self.__application_name}:{self.__application_version_next}'
+            self.__build_base = self.__get_base_name__(self.__build_parent)
         else:
             sys.exit(f'You must only choose application or build for image_type')
 
+        labels = {'Application': self.__application_name,
+                  'ApplicationVersion': f'{self.__application_version_next}'}
+        self.__set_buildx_outputs__(current_directory, image_tag, push)
         logging.warning(f'Building {current_directory}/Dockerfile with tag {image_tag}')
-        results = self.__docker_env.images.build(
-            path=current_directory,
-            tag=image_tag,
-            quiet=False,
-            labels={'Application': self.__application_name,
-                    'ApplicationVersion': f'{round(self.__application_version_next, 4)}'}
+        image_id = self.__stream_build__(
+            current_directory,
+            image_tag,
+            labels=labels
         )
-        logging.warning(f'Completed build of id {results[0].id}')
+        logging.warning(f'Completed build of id {image_id}')
+        self.__touch_image__(image_id)
+        self.__size_report = self.__image_size.analyze(self.__docker_env, image_id, current_directory)
         return image_tag
 
+    def uses_zstd(self):
+        return self.__compression == 'zstd'
+
+    def get_buildx_push(self):
+        return self.__buildx_push
+
+    def __set_buildx_outputs__(self, current_directory, image_tag, push):
+        """
+        Work out the extra outputs of the next build. When there are any the one build runs through
+        docker buildx, loads the image into docker and also pushes or exports it, so what is pushed
+        or exported is the image that was built and checked.
+        :param current_directory: string
+        :param image_tag: string
+        :param push: bool
+        :return: list of buildx outputs
+        """
+        self.__build_report = None
+        self.__size_report = None
+        self.__buildx_push = None
+        self.__buildx_outputs = []
+        if self.__oci_export:
+            self.__buildx_outputs.append(f'type=oci,dest={current_directory}{os.path.sep}image-oci.tar,'
+                                         f'name={image_tag},{self.__compression_options__()}')
+        if push and self.uses_zstd():
+            self.__buildx_outputs.append(f'type=image,name={image_tag},push=true,{self.__compression_options__()}')
+        if self.__buildx_outputs:
+            self.__buildx_outputs.insert(0, f'type=docker,name={image_tag}')
+
+        return self.__buildx_outputs
+
+    def __compression_options__(self):
+        """
+        Exporter options for COMPRESSION, zstd needs OCI media types and recompresses layers from the cache
+        :return: string
+        """
+        if self.__compression == 'zstd':
+            return 'compression=zstd,force-compression=true,oci-mediatypes=true'
+
+        return 'compression=gzip'
+
+    def __stream_build__(self, current_directory, image_tag, labels, network_mode=None):
+        """
+        Build through the low level api so every step is logged as it happens and timed.
+        Timings are written to build-report.json in the build directory with the item each
+        Dockerfile instruction came from.
+        :param current_directory: string
+        :param image_tag: string
+        :param labels: dict
+        :param network_mode: string
+        :return: string image id
+        """
+        with open(f'{current_directory}{os.path.sep}Dockerfile', 'r') as in_:
+            instructions = DockerfileOptimizer.parse_instructions(in_.readlines())
+
+        stages = []
+        stage = None
+        for instruction, arguments, items in instructions:
+            if instruction == 'FROM':
+                stage = arguments.split()[-1] if ' as ' in arguments.lower() else arguments
+            stages.append(stage)
+
+        context = self.__get_context_size__(current_directory)
+        if self.__buildkit or self.__buildx_outputs:
+            if network_mode:
+                logging.warning(f'BuildKit only supports the default, host and none networks, '
+                                f'not using {network_mode}')
+            return self.__stream_buildkit__(current_directory, image_tag, labels, instructions, stages, context)
+
+        image_id = None
+        steps = []
+        started = time.time()
+        step_started = started
+        build_thread = threading.get_ident()
+
+        def keep_response_(response_, *args_, **kwargs_):
+            # Keep the streamed response of this build so cancel can drop its connection
+            if threading.get_ident() == build_thread and response_.request.path_url.split('?')[0].endswith('/build'):
+                self.__build_response = response_
+            return response_
+
+        self.__docker_env.api.hooks['response'].append(keep_response_)
+        try:
+            output = self.__docker_env.api.build(
+                path=current_directory,
+                tag=image_tag,
+                labels=labels,
+                network_mode=network_mode,
+                rm=True,
+                decode=True,
+                timeout=120,
+            )
+        finally:
+            self.__docker_env.api.hooks['response'].remove(keep_response_)
+        if self.__cancel.is_set():
+            self.__close_build_response__()
+        try:
+            for chunk in output:
+                if self.__cancel.is_set():
+                    break
+
+                if chunk.get('error'):
+                    logging.warning(chunk.get('error').strip())
+                    self.__write_build_report__(current_directory, image_tag, image_id, started, steps, context)
+                    sys.exit(f'Build of {image_tag} failed at step {len(steps)}: {chunk.get("error").strip()}')
+
+                if chunk.get('aux', {}).get('ID'):
+                    image_id = chunk.get('aux').get('ID')
+
+                for line in (chunk.get('stream') or '').splitlines():
+                    if not line.strip():
+                        continue
+                    logging.warning(line.rstrip())
+                    if line.startswith('Step ') and ' : ' in line:
+                        now = time.time()
+                        if steps:
+                            steps[-1]['seconds'] = round(now - step_started, 3)
+                        step_started = now
+                        index = int(line.split()[1].split('/')[0]) - 1
+                        steps.append({
+                            'step': index + 1,
+                            'stage': stages[index] if index < len(stages) else None,
+                            'items': instructions[index][2] if index < len(instructions) else [],
+                            'instruction': line.split(' : ', 1)[1],
+                            'cached': False,
+                            'seconds': None,
+                        })
+                    elif 'Using cache' in line and steps:
+                        steps[-1]['cached'] = True
+        except Exception:
+            # Dropping the connection in cancel makes the read fail
+            if not self.__cancel.is_set():
+                raise
+        finally:
+            self.__build_response = None
+
+        if self.__cancel.is_set():
+            # Without the connection the daemon stops the build
+            self.__write_build_report__(current_directory, image_tag, None, started, steps, context)
+            raise BuildCancelled(f'Build of {image_tag} was cancelled at step {len(steps)}')
+
+        if steps:
+            steps[-1]['seconds'] = round(time.time() - step_started, 3)
+
+        self.__write_build_report__(current_directory, image_tag, image_id, started, steps, context)
+        return image_id
+
+    def __stream_buildkit__(self, current_directory, image_tag, labels, instructions, stages, context):
+        """
+        Build with BuildKit through the docker cli, as the api does not support it, timing each step
+        from the plain progress output. With buildx outputs the build runs through docker buildx and
+        the result of a push is kept from its metadata.
+        :param current_directory: string
+        :param image_tag: string
+        :param labels: dict
+        :param instructions: list of parsed instructions
+        :param stages: list of stage name per instruction
+        :param context: dict
+        :return: string image id
+        """
+        image_id_file = f'{current_directory}{os.path.sep}.image-id'
+        metadata_file = f'{current_directory}{os.path.sep}.buildx-metadata.json'
+        command = ['docker', 'build', '--progress=plain', '--iidfile', image_id_file, '--tag', image_tag]
+        if self.__buildx_outputs:
+            command[1:2] = ['buildx', 'build']
+            command.extend(['--metadata-file', metadata_file])
+            if self.__buildx_builder:
+                command.extend(['--builder', self.__buildx_builder])
+            for output_ in self.__buildx_outputs:
+                command.extend(['--output', output_])
+        for key_, value_ in labels.items():
+            command.extend(['--label', f'{key_}={value_}'])
+        command.append(current_directory)
+
+        unmatched = [(stages[i_], ' '.join(f'{instruction} {arguments}'.split()), items)
+                     for i_, (instruction, arguments, items) in enumerate(instructions)]
+        step_pattern = re.compile(r'^#(\d+) \[(\S+) (\d+)/(\d+)\] (.*)$')
+        vertices = {}
+        steps = []
+        started = time.time()
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True,
+                                   env=dict(DockerHostPool.environment(self.__docker_host), DOCKER_BUILDKIT='1'))
+        self.__build_process = process
+        if self.__cancel.is_set():
+            process.terminate()
+        for line in process.stdout:
+            if not line.strip():
+                continue
+            logging.warning(line.rstrip())
+            step_match = step_pattern.match(line.strip())
+            if step_match:
+                text = ' '.join(step_match.group(5).split())
+                items = []
+                for index, (stage_, text_, items_) in enumerate(unmatched):
+                    if stage_ == step_match.group(2) and text_ == text:
+                        items = unmatched.pop(index)[2]
+                        break
+                vertices[step_match.group(1)] = {
+                    'step': len(steps) + 1,
+                    'stage': step_match.group(2),
+                    'items': items,
+                    'instruction': step_match.group(5),
+                    'cached': False,
+                    'seconds': None,
+                }
+                steps.append(vertices[step_match.group(1)])
+                continue
+
+            parts = line.split()
+            if len(parts) >= 2 and parts[0].startswith('#') and parts[0][1:] in vertices:
+                if parts[1] == 'CACHED':
+                    vertices[parts[0][1:]]['cached'] = True
+                    vertices[parts[0][1:]]['seconds'] = 0
+                elif parts[1] == 'DONE' and len(parts) > 2:
+                    vertices[parts[0][1:]]['seconds'] = float(parts[2].rstrip('s'))
+
+        if process.wait() != 0:
+            self.__write_build_report__(current_directory, image_tag, None, started, steps, context)
+            if self.__cancel.is_set():
+                raise BuildCancelled(f'Build of {image_tag} was cancelled')
+            sys.exit(f'Build of {image_tag} failed with exit code {process.returncode}')
+
+        with open(image_id_file, 'r') as in_:
+            image_id = in_.read().strip()
+
+        if any('push=true' in o_ for o_ in self.__buildx_outputs or []):
+            with open(metadata_file, 'r') as in_:
+                digest = json.load(in_).get('containerimage.digest')
+            self.__buildx_push = {'image': image_tag, 'digest': digest, 'compression': self.__compression}
+            logging.warning(f'Pushed {image_tag} {digest} with {self.__compression} layers from the build')
+
+        self.__write_build_report__(current_directory, image_tag, image_id, started, steps, context)
+        return image_id
+
+    def cancel(self):
+        """
+        Stop the build that is running, it raises BuildCancelled in the thread that started it
+        :return: None
+        """
+        self.__cancel.set()
+        if self.__build_process and self.__build_process.poll() is None:
+            self.__build_process.terminate()
+        self.__close_build_response__()
+
+    def __close_build_response__(self):
+        """
+        Shut the connection of a build streamed through the api, which unblocks a read waiting on a
+        step that prints nothing and makes the daemon stop the build
+        :return: None
+        """
+        response = self.__build_response
+        if response is None:
+            return
+
+        try:
+            # Plain and unix connections give the socket file, closing the response instead would wait
+            # for the lock the reading thread holds
+            raw_socket = self.__docker_env.api._get_raw_response_socket(response)
+            getattr(raw_socket, '_sock', raw_socket).shutdown(socket.SHUT_RDWR)
+        except (AttributeError, OSError) as oe:
+            logging.warning(f'Could not shut the build connection: {oe}')
+
+    def get_item_folders(self, image_type):
+        """
+        Component folders of the selected items for the base, the folders a change in means the
+        Dockerfile has to be generated again
+        :param image_type: string only (application|build)
+        :return: list
+        """
+        if image_type == 'application':
+            current_name, current_items = self.__application_parent, self.__application_items
+        else:
+            current_name, current_items = self.__build_parent, self.__build_items
+
+        base_name = self.__get_base_name__(current_name)
+        return [self.__catalog.get_base_folder(self.__catalog.get(item_, base_name))
+                for item_ in self.__input_to_list__(current_items)]
+
+    def __write_build_report__(self, current_directory, image_tag, image_id, started, steps, context=None):
+        """
+        Write step timings and the total time per item as build-report.json and add them to the item history
+        :param current_directory: string
+        :param image_tag: string
+        :param image_id: string
+        :param started: float
+        :param steps: list of dict
+        :param context: dict of files and bytes sent to docker
+        :return: dict
+        """
+        item_seconds = {}
+        for step in steps:
+            for item_ in step.get('items') or ['']:
+                item_seconds[item_] = round(item_seconds.get(item_, 0) + (step.get('seconds') or 0)
+                                            / max(len(step.get('items')), 1), 3)
+
+        report = {
+            'image': image_tag,
+            'id': image_id,
+            'started': datetime.datetime.fromtimestamp(started).isoformat(),
+            'seconds': round(time.time() - started, 3),
+            'context': context,
+            'items': dict(sorted(item_seconds.items(), key=lambda i_: i_[1], reverse=True)),
+            'steps': steps,
+        }
+        with open(f'{current_directory}{os.path.sep}build-report.json', 'w') as out_:
+            json.dump(report, out_, indent=2)
+        if self.__order == 'cache':
+            self.__history.record_build(steps, self.__build_base)
+        self.__build_report = report
+
+        for item_, seconds in report.get('items').items():
+            logging.warning(f'{item_ or "(stage)"} took {seconds}s')
+
+        return report
+
+    def get_build_report(self):
+        return self.__build_report
+
+    def get_size_report(self):
+        return self.__size_report
+
+    def __touch_image__(self, image_id):
+        """
+        Mark image as used in the local image cache if one was set
+        :param image_id: string
+        :return: None
+        """
+        if self.__image_cache:
+            self.__image_cache.touch(image_id)
+
+    def get_build_hash(self):
+        """
+        Content hash over everything that feeds the multi stage build: the generated Dockerfile and
+        .dockerignore, the files of the selected component folders and the cloned commit.
+        Identical hash means identical image, whatever build options produced the Dockerfile.
+        :return: string
+        """
+        if self.__build_hash:
+            return self.__build_hash
+
+        build_hash = hashlib.sha256()
+        for value in [self.__git_url, self.__git_branch, self.__git_commit]:
+            build_hash.update(f'{value}\n'.encode('utf-8'))
+        for file_name_ in ['Dockerfile', '.dockerignore']:
+            generated_file = f'{self.__multi_build_folder}{os.path.sep}{file_name_}'
+            if os.path.exists(generated_file):
+                with open(generated_file, 'rb') as in_:
+                    build_hash.update(f'{file_name_}\n'.encode('utf-8'))
+                    build_hash.update(in_.read())
+
+        base_name = self.__get_base_name__(self.__build_parent)
+        items = self.__input_to_list__(self.__build_items) + self.__input_to_list__(self.__application_items)
+        for item_ in items:
+            build_hash.update(f'{item_}\n{self.__catalog.get(item_, base_name).get("hash")}\n'.encode('utf-8'))
+
+        self.__build_hash = build_hash.hexdigest()
+        return self.__build_hash
+
+    def find_cached_image(self):
+        """
+        Look for a local image that was built from the same build hash
+        :return: image or None
+        """
+        images = self.__docker_env.images.list(filters={'label': f'BuildHash={self.get_build_hash()}'})
+        if images:
+            return images[0]
+
+        return None
+
     @staticmethod
     def __get_base_name__(parent_name_):
         """
@@ -333,19 +1040,20 @@ class DockerHelper:
         return base_name_
 
     @staticmethod
-    def __get_directory_contents__(working_directory_):
+    def __shared_prefix__(code_items_, app_items_):
         """
-        Get all files in folder (includes subdirectories)
-        :param working_directory_: string
+        Get the items both stages start with, in order, so they can be built once
+        :param code_items_: list
+        :param app_items_: list
         :return: list
         """
-        found_contents = []
-        for (root, dirs, files) in os.walk(working_directory_):
-            items_ = [os.path.join(root, f_) for f_ in files]
-            if items_:
-                found_contents = items_
+        shared_ = []
+        for code_item_, app_item_ in zip(code_items_, app_items_):
+            if code_item_ != app_item_:
+                break
+            shared_.append(code_item_)
 
-        return found_contents
+        return shared_
 
     @staticmethod
     def __input_to_list__(comma_delimited_):
@@ -360,31 +1068,6 @@ class DockerHelper:
 
         return list_
 
-    @staticmethod
-    def __path_exists__(path_):
-        """
-        Check of directory exists and return true or stop execution as all directories should exist
-        :param path_: string
-        :return: bool
-        """
-        if os.path.exists(path_):
-            return True
-        else:
-            sys.exit(f'{path_} did not exist.')
-
-    @staticmethod
-    def __reset_docker_folder__(build_):
-        """
-        Remove directories before starting work to ensure its only what we want
-        :param build_: string
-        :return: None
-        """
-        if os.path.exists(build_):
-            os.system(f'rm -rf {build_}')  # Does not work in windows
-            # shutil.rmtree(build_)
-
-        os.mkdir(build_)
-
     def set_repository_uri(self, uri):
         self.__repository_uri = uri
 
@@ -397,223 +1080,1911 @@ class DockerHelper:
     def set_network(self, network):
         self.__network = network
 
+    def set_git_commit(self, commit):
+        self.__git_commit = commit
+        self.__build_hash = None
 
-class EcrHelper:
+    def set_image_cache(self, image_cache):
+        self.__image_cache = image_cache
 
-    __session = None
-    __repository_name = None
-    __registry_id = None
-    __repository_uri = None
-    __docker_env = None
-    __application_name = None
-    __application_version_base = None
-    __application_version_current = None
-    __application_version_next = None
-    __docker_directory = None
-    __network = None
-    __network_name = None
+    def set_parent_pins(self, parent_pins):
+        self.__parent_pins = parent_pins
+        self.__build_hash = None
 
-    def __init__(self, input_helper):
-        self.__session = boto3.Session(profile_name=input_helper.get_ecr_repository('PROFILE_NAME'))
-        self.__repository_name = input_helper.get_ecr_repository('NAME')
-        self.__application_name = input_helper.get_application('NAME')
-        self.__docker_directory = input_helper.get_application_image('DIRECTORY')
-        self.__network_name = input_helper.get_application_image('NETWORK_NAME')
-        self.__application_version_base = round(float(input_helper.get_application('BASE_VERSION')), 4)
-        self.__application_version_current = round(float(input_helper.get_application('BASE_VERSION')), 4)
-        self.get_create_repository()
-        self.registry_login()
-        self.registry_prune()
-        self.registry_get_latest()
-        self.__create_my_network__()
 
-    def get_repository(self):
-        """
-        Get ecr repository from AWS
-        :return: dict
-        """
-        found_repository = {}
-        results = self.__session.client('ecr').describe_repositories()
-        if results.get('repositories'):
-            if len(results.get('repositories')) > 1:
-                sys.exit(f'Something wrong found multiple {self.__repository_name}: {results.get("repositories")}')
-            else:
-                found_repository = results.get('repositories')[-1]
-                if results.get('repositories')[-1].get('registryId'):
-                    self.__registry_id = results.get('repositories')[-1].get('registryId')
-                    self.__repository_uri = results.get('repositories')[-1].get('repositoryUri')
+class VersionIndexHelper:
+    """
+    Local index of application versions found in an ecr repository, keyed by application name.
+    Kept up to date from uploads so ecr only has to be listed when the index is cold.
+    """
 
-        return found_repository
+    __index_file = None
+    __lock = threading.Lock()
 
-    def get_repositories(self):
+    def __init__(self, input_helper, repository_name):
+        cache_directory = input_helper.get_build_cache('DIRECTORY', '.build_cache')
+        os.makedirs(cache_directory, exist_ok=True)
+        self.__index_file = f'{cache_directory}{os.path.sep}versions-{repository_name}.json'
+
+    @staticmethod
+    def version_key(version):
         """
-        Get ecr repositories from AWS
-        :return: list of dict
+        Sortable key so 0.10 comes after 0.9
+        :param version: string
+        :return: tuple
         """
-        found_repositories = []
-        keep_searching = True
-        next_token = None
-        while keep_searching:
-            if next_token:
-                results = self.__session.client('ecr').describe_repositories(nextToken=next_token)
-            else:
-                results = self.__session.client('ecr').describe_repositories()
+        return tuple(int(p_) for p_ in version.split('.'))
 
-            if results:
-                if results.get('nextToken'):
-                    next_token = results.get('nextToken')
-                else:
-                    keep_searching = False
+    @staticmethod
+    def split_tag(tag):
+        """
+        Split an image tag into application name and version
+        :param tag: string like amazonlinux-spring-boot-0.1
+        :return: tuple of name and version, or None when the tag has no version
+        """
+        if not tag or '-' not in tag:
+            return None
 
-                if results.get('repositories'):
-                    found_repositories.extend(results.get('repositories'))
+        name, version = tag.rsplit('-', 1)
+        if not all(p_.isdigit() for p_ in version.split('.')):
+            return None
 
-        return found_repositories
+        return name, version
 
-    def create_repository(self):
+    def get_versions(self, application_name):
         """
-        Create ecr repository in AWS
-        :return: dict
+        Get known versions of an application
+        :param application_name: string
+        :return: list or None when the index is cold
         """
-        new_repository = {}
-        results = self.__session.client('ecr').create_repository(
-            repositoryName=self.__repository_name,
-            imageScanningConfiguration={
-                'scanOnPush': True
-            },
-            imageTagMutability='IMMUTABLE',
-            encryptionConfiguration={
-                'encryptionType': 'AES256'
-            }
-        )
-        if results.get('repository'):
-            new_repository = results.get('repository')
-            if results.get('repository').get('registryId'):
-                self.__registry_id = results.get('repository').get('registryId')
-                self.__repository_uri = results.get('repository').get('repositoryUri')
+        with self.__lock:
+            index = self.__read_index__()
 
-        return new_repository
+        if index is None:
+            return None
 
-    def get_create_repository(self):
+        return index.get(application_name, [])
+
+    def add(self, tag):
         """
-        Get repository from ecr and if missing or not found create it
-        :return: dict
+        Add a pushed tag to the index
+        :param tag: string
+        :return: None
         """
-        repository_lookup = self.get_repository()
-        if repository_lookup:
-            logging.warning(f'Repository {self.__repository_name} existed')
-            repository_info = repository_lookup
-        else:
-            logging.warning(f'Repository {self.__repository_name} created')
-            repository_info = self.create_repository()
-
-        return repository_info
-
-    def registry_login(self):
+        name_version = self.split_tag(tag)
+        if not name_version:
+            return
+
+        with self.__lock:
+            index = self.__read_index__() or {}
+            versions = index.setdefault(name_version[0], [])
+            if name_version[1] not in versions:
+                versions.append(name_version[1])
+                versions.sort(key=self.version_key)
+            self.__write_index__(index)
+
+    def replace(self, tags):
         """
-        Log into ecr repository in aws
+        Replace the whole index from a full listing of tags
+        :param tags: list
         :return: None
         """
-        logging.warning(f'Logging into registry {self.__repository_uri}')
+        index = {}
+        for tag in tags:
+            name_version = self.split_tag(tag)
+            if name_version:
+                index.setdefault(name_version[0], []).append(name_version[1])
+
+        for versions in index.values():
+            versions.sort(key=self.version_key)
+
+        with self.__lock:
+            self.__write_index__(index)
+
+    def __read_index__(self):
+        """
+        Read the index file
+        :return: dict or None
+        """
+        if not os.path.exists(self.__index_file):
+            return None
+
+        with open(self.__index_file, 'r') as in_:
+            return json.load(in_)
+
+    def __write_index__(self, index):
+        """
+        Write the index file
+        :param index: dict
+        :return: None
+        """
+        with open(f'{self.__index_file}.tmp', 'w') as out_:
+            json.dump(index, out_, indent=2)
+        os.replace(f'{self.__index_file}.tmp', self.__index_file)
+
+
+class StagingHelper:
+    """
+    Stage files into a build directory, only copying or linking files that changed since the last run.
+    A manifest of what was staged is kept so stale files can be removed without touching anything
+    else in the directory, such as the cloned code.
+    """
+
+    MANIFEST = '.staging-manifest.json'
+
+    __directory = None
+    __link = False
+    __manifest = None
+    __staged = None
+
+    def __init__(self, directory, link=False):
+        self.__directory = directory
+        self.__link = link
+        self.__staged = {}
+        os.makedirs(directory, exist_ok=True)
+        manifest_file = f'{directory}{os.path.sep}{self.MANIFEST}'
+        self.__manifest = {}
+        if os.path.exists(manifest_file):
+            with open(manifest_file, 'r') as in_:
+                self.__manifest = json.load(in_)
+
+    def stage(self, source, name=None):
+        """
+        Copy or hardlink source into the directory unless the same source was staged there unchanged
+        :param source: string
+        :param name: string path relative to the directory, defaults to the source file name
+        :return: string staged path
+        """
+        name = name or os.path.basename(source)
+        destination = f'{self.__directory}{os.path.sep}{name}'
+        source_stat = os.stat(source)
+        entry = {'source': os.path.abspath(source), 'size': source_stat.st_size, 'mtime': source_stat.st_mtime_ns}
+        self.__staged[name] = entry
+        if self.__manifest.get(name) == entry and os.path.exists(destination):
+            return destination
+
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        if os.path.lexists(destination):
+            os.remove(destination)
+        if self.__link:
+            try:
+                os.link(source, destination)
+                return destination
+            except OSError:
+                logging.warning(f'Could not link {source}, copying instead')
+
+        shutil.copy2(source, destination)
+        return destination
+
+    def write(self, name, lines):
+        """
+        Write generated lines to a file, leaving the file alone when the content is the same
+        :param name: string path relative to the directory
+        :param lines: list
+        :return: string written path
+        """
+        destination = f'{self.__directory}{os.path.sep}{name}'
+        content = ''.join(lines)
+        content_hash = hashlib.sha256(content.encode('utf-8')).hexdigest()
+        entry = {'source': None, 'hash': content_hash}
+        self.__staged[name] = entry
+        if self.__manifest.get(name) == entry and os.path.exists(destination):
+            return destination
+
+        with open(destination, 'w') as out_:
+            out_.write(content)
+
+        return destination
+
+    def finish(self):
+        """
+        Remove files staged by a previous run that were not staged by this one and save the manifest
+        :return: list of removed paths
+        """
+        removed = []
+        for name in set(self.__manifest) - set(self.__staged):
+            destination = f'{self.__directory}{os.path.sep}{name}'
+            if os.path.lexists(destination):
+                os.remove(destination)
+                removed.append(destination)
+
+        self.__manifest = dict(self.__staged)
+        with open(f'{self.__directory}{os.path.sep}{self.MANIFEST}', 'w') as out_:
+            json.dump(self.__manifest, out_, indent=2)
+
+        return removed
+
+
+class ItemHistoryHelper:
+    """
+    History of each item across generations and builds: how often its content changed, how often it was
+    the first step of its stage to miss the layer cache and how long its steps take when they run.
+    Used to order stable, expensive items first so changes invalidate as few layers as possible.
+    An item is kept per base, its content and cost differ from one base to another.
+    """
+
+    __history_file = None
+    __lock = threading.Lock()
+
+    def __init__(self, input_helper):
+        cache_directory = input_helper.get_build_cache('DIRECTORY', '.build_cache')
+        os.makedirs(cache_directory, exist_ok=True)
+        self.__history_file = f'{cache_directory}{os.path.sep}history.json'
+
+    def record_generation(self, item_hashes, base_name):
+        """
+        Count a generation of each item and whether its content changed since the last one
+        :param item_hashes: dict of item to catalog hash
+        :param base_name: string
+        :return: None
+        """
+        with self.__lock:
+            history = self.__read_history__()
+            for item_, hash_ in item_hashes.items():
+                entry = history.setdefault(self.__history_key__(item_, base_name), {})
+                if entry.get('hash') and entry.get('hash') != hash_:
+                    entry['changes'] = entry.get('changes', 0) + 1
+                entry['hash'] = hash_
+                entry['generations'] = entry.get('generations', 0) + 1
+            self.__write_history__(history)
+
+    def record_build(self, steps, base_name):
+        """
+        Count a build of each item from the steps of a build report, whether it ran and for how long,
+        and whether it was the first step of its stage that was not cached
+        :param steps: list of dict
+        :param base_name: string
+        :return: None
+        """
+        built = {}
+        missed_stages = set()
+        for step in steps:
+            for item_ in step.get('items') or []:
+                built.setdefault(item_, {'executed': False, 'missed': False, 'seconds': 0})
+                if not step.get('cached'):
+                    built[item_]['executed'] = True
+                    built[item_]['seconds'] += step.get('seconds') or 0
+                    if step.get('stage') not in missed_stages:
+                        built[item_]['missed'] = True
+            if step.get('items') and not step.get('cached'):
+                missed_stages.add(step.get('stage'))
+
+        with self.__lock:
+            history = self.__read_history__()
+            for item_, build_ in built.items():
+                entry = history.setdefault(self.__history_key__(item_, base_name), {})
+                entry['builds'] = entry.get('builds', 0) + 1
+                if build_.get('missed'):
+                    entry['misses'] = entry.get('misses', 0) + 1
+                if build_.get('executed'):
+                    entry['executed'] = entry.get('executed', 0) + 1
+                    entry['seconds'] = round(entry.get('seconds', 0) + build_.get('seconds'), 3)
+            self.__write_history__(history)
+
+    def order(self, items, requires, base_name, shared=None):
+        """
+        Order items so declared dependencies come first, then items that rarely change before ones that
+        often do and, among those, items shared by stages and then the most expensive first. Items without
+        history keep their place among each other.
+        :param items: list
+        :param requires: dict of item to list of required items
+        :param base_name: string
+        :param shared: list of items used by every stage, they can be built once when they come first
+        :return: list
+        """
+        with self.__lock:
+            history = self.__read_history__()
+
+        keys = {item_: self.__key__(history.get(self.__history_key__(item_, base_name), {}),
+                                    item_ in (shared or []), index)
+                for index, item_ in enumerate(items)}
+        ordered = []
+        remaining = list(items)
+        while remaining:
+            ready = [i_ for i_ in remaining
+                     if all(r_ in ordered or r_ not in remaining for r_ in requires.get(i_, []))]
+            if not ready:
+                sys.exit(f'Items {remaining} require each other')
+            next_item = min(ready, key=keys.get)
+            ordered.append(next_item)
+            remaining.remove(next_item)
+
+        return ordered
+
+    @staticmethod
+    def __history_key__(item, base_name):
+        """
+        Key of an item in the history
+        :param item: string
+        :param base_name: string
+        :return: string
+        """
+        return f'{item}/{base_name}'
+
+    @staticmethod
+    def __key__(entry, shared, index):
+        """
+        Sort key of an item: how often it changes, rounded so small differences do not outweigh cost,
+        then shared items first, then the average seconds its steps take when they run, then its
+        selected position
+        :param entry: dict
+        :param shared: bool
+        :param index: int
+        :return: tuple
+        """
+        change_rate = max(entry.get('changes', 0) / max(entry.get('generations', 0), 1),
+                          entry.get('misses', 0) / max(entry.get('builds', 0), 1))
+        cost = entry.get('seconds', 0) / max(entry.get('executed', 0), 1)
+        return round(change_rate, 1), not shared, -round(cost), index
+
+    def __read_history__(self):
+        """
+        Read the item history
+        :return: dict
+        """
+        if os.path.exists(self.__history_file):
+            with open(self.__history_file, 'r') as in_:
+                return json.load(in_)
+
+        return {}
+
+    def __write_history__(self, history):
+        """
+        Write the item history
+        :param history: dict
+        :return: None
+        """
+        with open(f'{self.__history_file}.tmp', 'w') as out_:
+            json.dump(history, out_, indent=2, sort_keys=True)
+        os.replace(f'{self.__history_file}.tmp', self.__history_file)
+
+
+class TokenHelper:
+    """
+    Replace @TOKEN@ in item Dockerfiles in a single pass. Every parameter of the inputs file is a token:
+    @KEY@ when only one section has the key, otherwise @SECTION.KEY@. The tokens section adds user defined
+    tokens and overrides any other. Tokens without a value are collected so they can be reported at once.
+    """
+
+    PATTERN = re.compile(r'@([A-Za-z][A-Za-z0-9_.]*)@')
+
+    __tokens = None
+    __user_tokens = None
+    __unknown = None
+
+    def __init__(self, input_helper):
+        sections = input_helper.get_sections()
+        key_counts = {}
+        for values_ in sections.values():
+            for key_ in values_:
+                key_counts[key_] = key_counts.get(key_, 0) + 1
+
+        self.__tokens = {}
+        for section_, values_ in sections.items():
+            for key_, value_ in values_.items():
+                self.__tokens[f'{section_.upper()}.{key_}'] = value_
+                if key_counts[key_] == 1:
+                    self.__tokens[key_] = value_
+
+        exec_command = input_helper.get_application_build('EXEC_COMMAND')
+        self.__tokens.update({
+            'URL': input_helper.get_application_build('URL'),
+            'BRANCH': input_helper.get_application_build('BRANCH'),
+            'FOLDER': input_helper.get_application_build('BUILD_FOLDER'),
+            'TIMEZONE': input_helper.get_application_image('TIMEZONE'),
+            'EXEC': f'/code/{exec_command}' if 'gradlew' in exec_command else exec_command,
+            'OPTS': input_helper.get_application_build('EXEC_OPTIONS'),
+        })
+        self.__user_tokens = sections.get('tokens', {})
+        self.__tokens.update(self.__user_tokens)
+        self.__unknown = {}
+
+    def replace(self, lines, source=None):
+        """
+        Replace tokens in lines, lines without @ are passed through untouched
+        :param lines: list
+        :param source: string file the lines came from, used when reporting unknown tokens
+        :return: list
+        """
+        updated_lines = []
+        for line in lines:
+            if '@' in line:
+                updated_lines.append(self.PATTERN.sub(lambda m_: self.__value__(m_, source), line))
+            else:
+                updated_lines.append(line)
+
+        return updated_lines
+
+    def __value__(self, match, source):
+        """
+        Value of one token, unknown tokens are recorded and left in place
+        :param match: re.Match
+        :param source: string
+        :return: string
+        """
+        value = self.__tokens.get(match.group(1))
+        if value is None:
+            sources = self.__unknown.setdefault(match.group(1), [])
+            if source not in sources:
+                sources.append(source)
+            return match.group(0)
+
+        return value
+
+    def get_unknown(self):
+        return self.__unknown
+
+    def get_user_tokens(self):
+        return self.__user_tokens
+
+    def get_tokens(self):
+        return self.__tokens
+
+
+class CatalogHelper:
+    """
+    Index of the component folders looked up so far: for each base its Dockerfile, assets (including
+    nested ones, by path relative to the base folder), content hashes, description and declared
+    dependencies. Entries are added when an item is first looked up and only rescanned when a file or
+    folder in them changed, so looking up the selected items costs the same however many components there are.
+    """
+
+    REQUIRES_MARKER = '# requires: '
+
+    __root = None
+    __index_file = None
+    __indexes = {}
+    __lock = threading.Lock()
+
+    def __init__(self, input_helper, root=None):
+        self.__root = root or os.getcwd()
+        cache_directory = input_helper.get_build_cache('DIRECTORY', '.build_cache')
+        os.makedirs(cache_directory, exist_ok=True)
+        self.__index_file = f'{cache_directory}{os.path.sep}catalog.json'
+
+    def get(self, item, base_name):
+        """
+        Get the catalog entry of one component for a base, rescanning it when it changed
+        :param item: string component folder
+        :param base_name: string
+        :return: dict
+        """
+        with self.__lock:
+            index = self.__read_index__()
+            entry = index.get(item, {}).get(base_name)
+            if entry is None or self.__is_stale__(entry):
+                entry = self.__scan__(item, base_name, entry)
+                index.setdefault(item, {})[base_name] = entry
+                self.__write_index__(index)
+
+        return entry
+
+    def __scan__(self, item, base_name, previous=None):
+        """
+        Walk the folder of a component for a base, only hashing files that changed since the previous entry
+        :param item: string
+        :param base_name: string
+        :param previous: dict or None
+        :return: dict
+        """
+        base_folder = f'{self.__root}{os.path.sep}{item}{os.path.sep}{base_name}'
+        if not os.path.exists(base_folder):
+            sys.exit(f'{base_folder} did not exist.')
+
+        previous_files = (previous or {}).get('files', {})
+        entry = {'directories': {}, 'files': {}, 'assets': [], 'requires': [], 'description': None}
+        for (root, dirs, files) in os.walk(base_folder):
+            dirs.sort()
+            entry['directories'][os.path.relpath(root, self.__root)] = os.stat(root).st_mtime_ns
+            for f_ in sorted(files):
+                file_ = os.path.join(root, f_)
+                relative_path = os.path.relpath(file_, base_folder)
+                file_stat = os.stat(file_)
+                known = previous_files.get(relative_path, {})
+                if known.get('size') == file_stat.st_size and known.get('mtime') == file_stat.st_mtime_ns:
+                    file_hash = known.get('sha256')
+                else:
+                    with open(file_, 'rb') as in_:
+                        file_hash = hashlib.sha256(in_.read()).hexdigest()
+                entry['files'][relative_path] = {'size': file_stat.st_size, 'mtime': file_stat.st_mtime_ns,
+                                                 'sha256': file_hash}
+                if relative_path != 'Dockerfile':
+                    entry['assets'].append(relative_path)
+
+        if not entry['files']:
+            sys.exit(f'{base_folder} was empty')
+        if 'Dockerfile' not in entry['files']:
+            sys.exit(f'{base_folder} is missing Dockerfile')
+
+        entry['dockerfile'] = os.path.relpath(f'{base_folder}{os.path.sep}Dockerfile', self.__root)
+        with open(f'{base_folder}{os.path.sep}Dockerfile', 'r') as in_:
+            for line_ in in_.read().splitlines():
+                if line_.startswith(self.REQUIRES_MARKER):
+                    entry['requires'].extend(r_.strip() for r_ in line_[len(self.REQUIRES_MARKER):].split(',')
+                                             if r_.strip())
+                elif entry['description'] is None and line_.startswith('LABEL description='):
+                    entry['description'] = line_[len('LABEL description='):].strip().strip('"')
+
+        entry_hash = hashlib.sha256()
+        for relative_path_, file_ in sorted(entry['files'].items()):
+            entry_hash.update(f'{relative_path_}\n{file_.get("sha256")}\n'.encode('utf-8'))
+        entry['hash'] = entry_hash.hexdigest()
+        return entry
+
+    def __is_stale__(self, entry):
+        """
+        Check if any folder or file of an entry changed, folders change when files are added or removed
+        :param entry: dict
+        :return: bool
+        """
+        try:
+            for folder_, mtime_ in entry.get('directories', {}).items():
+                if os.stat(f'{self.__root}{os.path.sep}{folder_}').st_mtime_ns != mtime_:
+                    return True
+            base_folder = os.path.dirname(f'{self.__root}{os.path.sep}{entry.get("dockerfile")}')
+            for relative_path_, file_ in entry.get('files', {}).items():
+                file_stat = os.stat(f'{base_folder}{os.path.sep}{relative_path_}')
+                if file_stat.st_size != file_.get('size') or file_stat.st_mtime_ns != file_.get('mtime'):
+                    return True
+        except OSError:
+            return True
+
+        return False
+
+    def get_base_folder(self, entry):
+        """
+        Absolute folder of a component for a base
+        :param entry: dict
+        :return: string
+        """
+        return os.path.dirname(f'{self.__root}{os.path.sep}{entry.get("dockerfile")}')
+
+    def __read_index__(self):
+        """
+        Read the catalog, kept in memory once read and shared by every helper using the same file
+        :return: dict
+        """
+        if self.__index_file not in self.__indexes:
+            index = {}
+            if os.path.exists(self.__index_file):
+                with open(self.__index_file, 'r') as in_:
+                    index = json.load(in_)
+            self.__indexes[self.__index_file] = index
+
+        return self.__indexes[self.__index_file]
+
+    def __write_index__(self, index):
+        """
+        Write the catalog
+        :param index: dict
+        :return: None
+        """
+        self.__indexes[self.__index_file] = index
+        with open(f'{self.__index_file}.tmp', 'w') as out_:
+            json.dump(index, out_, indent=2, sort_keys=True)
+        os.replace(f'{self.__index_file}.tmp', self.__index_file)
+
+
+class DockerfileOptimizer:
+    """
+    Rewrite the instructions of one stage into fewer, smaller layers.
+    RUN instructions not separated by another instruction are merged, consecutive package commands
+    are combined, the package cache is cleaned in the same layer and all LABEL instructions are
+    folded into one at the end of the stage.
+    """
+
+    PACKAGE_MANAGERS = {
+        'amazonlinux': {
+            'commands': ('yum',),
+            'clean': 'yum clean all && rm -rf /var/cache/yum',
+            'cache_targets': ('/var/cache/yum',),
+            'keep_cache': 'grep -qx keepcache=1 /etc/yum.conf || echo keepcache=1 >> /etc/yum.conf',
+        },
+        'ubuntu': {
+            'commands': ('apt-get', 'apt'),
+            'clean': 'apt-get clean && rm -rf /var/lib/apt/lists/*',
+            'cache_targets': ('/var/cache/apt', '/var/lib/apt/lists'),
+            'keep_cache': 'rm -f /etc/apt/apt.conf.d/docker-clean '
+                          '&& echo \'Binary::apt::APT::Keep-Downloaded-Packages "true";\' '
+                          '> /etc/apt/apt.conf.d/keep-cache',
+        },
+    }
+    # Actions whose packages can be given to one command
+    PACKAGE_ACTIONS = ('install', 'reinstall', 'remove', 'erase', 'purge', 'update', 'upgrade')
+    GRADLE_CACHE = '/root/.gradle'
+
+    __base_name = None
+    __package_manager = None
+    __clean = True
+
+    def __init__(self, base_name, clean=True):
+        self.__base_name = base_name
+        self.__clean = clean
+        self.__package_manager = self.PACKAGE_MANAGERS.get(base_name, {'commands': (), 'clean': None,
+                                                                       'cache_targets': (), 'keep_cache': None})
+
+    def optimize(self, lines):
+        """
+        Optimize the lines of one stage
+        :param lines: list
+        :return: list
+        """
+        labels = {}
+        label_items = []
+        instructions = []
+        for instruction, arguments, items in self.parse_instructions(lines):
+            if instruction == 'LABEL':
+                for key_, value_ in self.__parse_labels__(arguments):
+                    values = labels.setdefault(key_, [])
+                    if value_ not in values:
+                        values.append(value_)
+                label_items.extend(i_ for i_ in items if i_ not in label_items)
+            elif instruction == 'RUN' and self.__is_shell_form__(arguments) and instructions \
+                    and instructions[-1][0] == 'RUN' and isinstance(instructions[-1][1], list):
+                instructions[-1][1].append(self.__split_commands__(arguments))
+                instructions[-1][2].extend(i_ for i_ in items if i_ not in instructions[-1][2])
+            else:
+                # The exec form and RUN flags such as --mount are kept as they are and never merged
+                instructions.append((instruction, [self.__split_commands__(arguments)]
+                                     if instruction == 'RUN' and self.__is_shell_form__(arguments) else arguments,
+                                     list(items)))
+
+        optimized_lines = []
+        marked_items = None
+        for instruction, arguments, items in instructions:
+            if items != marked_items:
+                optimized_lines.append(f'{ITEM_MARKER}{",".join(items)}\n')
+                marked_items = items
+            if instruction == 'RUN' and isinstance(arguments, list):
+                # A subshell keeps a change of directory from reaching the commands of the next RUN merged
+                groups = [[f'({" && ".join(g_)})'] if self.__changes_directory__(g_) else g_ for g_ in arguments[:-1]]
+                commands = self.__combine_packages__([c_ for g_ in groups + arguments[-1:] for c_ in g_])
+                if self.__clean and self.__package_manager.get('clean') \
+                        and any(self.__is_package__(c_) for c_ in commands):
+                    commands.append(self.__package_manager.get('clean'))
+                optimized_lines.append('RUN ' + ' \\\n    && '.join(commands) + '\n')
+            else:
+                optimized_lines.append(f'{instruction} {arguments}\n')
+
+        if labels:
+            if label_items != marked_items:
+                optimized_lines.append(f'{ITEM_MARKER}{",".join(label_items)}\n')
+            optimized_lines.append(self.__fold_labels__(labels))
+
+        return optimized_lines
+
+    def flatten(self, lines, requires=None):
+        """
+        Rewrite the lines of one stage into a fixed number of layers: the files items copy, one RUN for
+        the items using the package manager and the items they require, then one RUN for all other items.
+        ENV and ARG move to the top, WORKDIR becomes a cd in the commands that follow it and instructions
+        that add no layer move to the end. Stages with instructions that cannot be moved are left as they are.
+        :param lines: list
+        :param requires: dict of item to list of required items
+        :return: list
+        """
+        leading = []
+        copies = []
+        trailing = []
+        labels = {}
+        label_items = []
+        commands = {}
+        workdir = None
+        workdir_item = None
+        for instruction, arguments, items in self.parse_instructions(lines):
+            item = ','.join(items)
+            commands.setdefault(item, [])
+            if instruction in ('ENV', 'ARG'):
+                leading.append((instruction, arguments, item))
+            elif instruction in ('COPY', 'ADD'):
+                if not arguments.split()[-1].startswith('/'):
+                    logging.warning(f'Not flattening, {item} copies to a relative path: {instruction} {arguments}')
+                    return lines
+                copies.append((instruction, arguments, item))
+            elif instruction == 'WORKDIR':
+                workdir = posixpath.join(workdir or '/', arguments)
+                workdir_item = item
+            elif instruction == 'RUN':
+                if not self.__is_shell_form__(arguments):
+                    logging.warning(f'Not flattening, {item} uses the exec form or flags of RUN: {arguments}')
+                    return lines
+                run_commands = self.__split_commands__(arguments)
+                if workdir:
+                    run_commands.insert(0, f'mkdir -p {workdir} && cd {workdir}')
+                run = ' && '.join(run_commands)
+                # A subshell keeps a change of directory from reaching the commands of other items
+                if self.__changes_directory__(run_commands):
+                    run = f'({run})'
+                commands[item].append(run)
+            elif instruction == 'LABEL':
+                for key_, value_ in self.__parse_labels__(arguments):
+                    values = labels.setdefault(key_, [])
+                    if value_ not in values:
+                        values.append(value_)
+                label_items.extend(i_ for i_ in items if i_ not in label_items)
+            elif instruction in ('EXPOSE', 'CMD', 'ENTRYPOINT', 'HEALTHCHECK', 'STOPSIGNAL'):
+                trailing.append((instruction, arguments, item))
+            else:
+                logging.warning(f'Not flattening, {item} uses {instruction} which cannot be moved')
+                return lines
+
+        package_items = [i_ for i_, c_ in commands.items() if any(self.__is_package__(command_)
+                                                                   for run_ in c_
+                                                                   for command_ in self.__split_commands__(run_))]
+        for item_ in package_items:
+            for requires_ in (requires or {}).get(item_, []):
+                if requires_ in commands and requires_ not in package_items:
+                    package_items.append(requires_)
+
+        flattened_lines = []
+        for instruction, arguments, item in leading + copies:
+            flattened_lines.append(f'{ITEM_MARKER}{item}\n')
+            flattened_lines.append(f'{instruction} {arguments}\n')
+        for layer_items in ([i_ for i_ in commands if i_ in package_items],
+                            [i_ for i_ in commands if i_ not in package_items]):
+            layer_commands = [run_ for item_ in layer_items for run_ in commands[item_]]
+            if not layer_commands:
+                continue
+            if self.__clean and self.__package_manager.get('clean') and layer_items[0] in package_items:
+                layer_commands.append(self.__package_manager.get('clean'))
+            flattened_lines.append(f'{ITEM_MARKER}{",".join(i_ for i_ in layer_items if commands[i_])}\n')
+            flattened_lines.append('RUN ' + ' \\\n    && '.join(layer_commands) + '\n')
+        if workdir:
+            trailing.insert(0, ('WORKDIR', workdir, workdir_item))
+        for instruction, arguments, item in trailing:
+            flattened_lines.append(f'{ITEM_MARKER}{item}\n')
+            flattened_lines.append(f'{instruction} {arguments}\n')
+        if labels:
+            flattened_lines.append(f'{ITEM_MARKER}{",".join(label_items)}\n')
+            flattened_lines.append(self.__fold_labels__(labels))
+
+        return flattened_lines
+
+    def add_cache_mounts(self, lines, cache_id):
+        """
+        Mount BuildKit caches into RUN instructions: the package cache of the base for package
+        commands and the gradle home for gradle builds, with the gradle build cache turned on.
+        Package commands are preceded by telling the package manager to keep what it downloads.
+        :param lines: list
+        :param cache_id: string shared by builds of the same base image
+        :return: list
+        """
+        cached_lines = []
+        keep_cache = self.__package_manager.get('keep_cache')
+        index = 0
+        while index < len(lines):
+            line = lines[index]
+            if not line.startswith('RUN '):
+                cached_lines.append(line)
+                index += 1
+                continue
+
+            instruction_lines = [line]
+            while instruction_lines[-1].rstrip().endswith('\\') and index + len(instruction_lines) < len(lines):
+                instruction_lines.append(lines[index + len(instruction_lines)])
+            index += len(instruction_lines)
+
+            commands = self.__split_commands__(' '.join(l_.strip().rstrip('\\') for l_ in instruction_lines)[4:])
+            mounts = []
+            prefix = ''
+            if any(self.__is_package__(c_) for c_ in commands):
+                if keep_cache:
+                    prefix = f'{keep_cache} && '
+                mounts.extend(f'--mount=type=cache,id={cache_id}{target.replace("/", "-")},target={target},sharing=locked'
+                              for target in self.__package_manager.get('cache_targets'))
+            if any('gradle' in c_ for c_ in commands):
+                mounts.append(f'--mount=type=cache,id={cache_id}-gradle,target={self.GRADLE_CACHE}')
+                instruction_lines = [l_.replace('--no-build-cache', '--build-cache') for l_ in instruction_lines]
+
+            if mounts:
+                instruction_lines[0] = f'RUN {" ".join(mounts)} {prefix}{instruction_lines[0][4:]}'
+            cached_lines.extend(instruction_lines)
+
+        return cached_lines
+
+    @staticmethod
+    def parse_instructions(lines):
+        """
+        Join continuation lines and split into (instruction, arguments, items), dropping comments and
+        blank lines. Items come from the item marker comments written by the generators.
+        :param lines: list
+        :return: list of tuple
+        """
+        parsed = []
+        current = ''
+        items = []
+        for line in lines:
+            stripped = line.strip()
+            if not current and stripped.startswith(ITEM_MARKER.strip()):
+                items = [i_ for i_ in stripped[len(ITEM_MARKER.strip()):].strip().split(',') if i_]
+                continue
+            # Docker drops comment and blank lines inside a continuation as well
+            if not stripped or stripped.startswith('#'):
+                continue
+            if stripped.endswith('\\'):
+                current += stripped[:-1] + ' '
+                continue
+            current += stripped
+            parts = current.split(None, 1)
+            if parts[0].upper() == 'FROM':
+                items = []
+            parsed.append((parts[0].upper(), parts[1] if len(parts) > 1 else '', items))
+            current = ''
+
+        return parsed
+
+    @staticmethod
+    def __parse_labels__(arguments):
+        """
+        Split LABEL arguments into key value pairs
+        :param arguments: string
+        :return: list of tuple
+        """
+        pairs = []
+        for token in shlex.split(arguments):
+            if '=' in token:
+                key_, value_ = token.split('=', 1)
+                pairs.append((key_, value_))
+
+        return pairs
+
+    def __fold_labels__(self, labels):
+        """
+        Fold labels into one LABEL instruction, values of the same key are joined with ;
+        :param labels: dict of key to list of values
+        :return: string
+        """
+        folded = [f'{key_}="{self.__escape__("; ".join(values))}"' for key_, values in labels.items()]
+        return 'LABEL ' + ' \\\n      '.join(folded) + '\n'
+
+    @staticmethod
+    def __escape__(value_):
+        """
+        Escape a label value for use inside double quotes
+        :param value_: string
+        :return: string
+        """
+        return value_.replace('\\', '\\\\').replace('"', '\\"')
+
+    @staticmethod
+    def __is_shell_form__(arguments):
+        """
+        Whether RUN arguments are a plain shell command, not the exec form and without flags
+        :param arguments: string
+        :return: bool
+        """
+        return not arguments.lstrip().startswith(('[', '--'))
+
+    @staticmethod
+    def __split_commands__(arguments):
+        """
+        Split a shell command on && that are not inside quotes
+        :param arguments: string
+        :return: list
+        """
+        commands = []
+        current = ''
+        quote = None
+        index = 0
+        while index < len(arguments):
+            char = arguments[index]
+            if quote:
+                if char == quote:
+                    quote = None
+                elif char == '\\' and quote == '"':
+                    current += char
+                    index += 1
+                    char = arguments[index] if index < len(arguments) else ''
+            elif char in ('"', "'"):
+                quote = char
+            elif arguments.startswith('&&', index):
+                commands.append(current.strip())
+                current = ''
+                index += 2
+                continue
+            current += char
+            index += 1
+        commands.append(current.strip())
+
+        return [c_ for c_ in commands if c_]
+
+    @staticmethod
+    def __changes_directory__(commands):
+        """
+        Check if any of the commands changes the directory
+        :param commands: list
+        :return: bool
+        """
+        return any(c_.startswith('cd ') or ' cd ' in c_ for c_ in commands)
+
+    def __is_package__(self, command):
+        """
+        Check if command runs the package manager of the base
+        :param command: string
+        :return: bool
+        """
+        return command.lstrip('(').split(None, 1)[0] in self.__package_manager.get('commands') \
+            if command.lstrip('(') else False
+
+    def __package_parts__(self, command):
+        """
+        Split a package command into the manager, the action, the flags and the packages. The action is the
+        first word that is not a flag.
+        :param command: string
+        :return: tuple or None if the command is no package command or uses quotes or shell operators
+        """
+        if not self.__is_package__(command) or any(c_ in command for c_ in '"\'|;<>$`()'):
+            return None
+        words = command.split()
+        others = [w_ for w_ in words[1:] if not w_.startswith('-')]
+
+        return words[0], others[0] if others else None, sorted(w_ for w_ in words[1:] if w_.startswith('-')), \
+            others[1:]
+
+    def __combine_packages__(self, commands):
+        """
+        Combine consecutive package commands with the same manager, action and flags into one and drop an
+        update that directly repeats the previous package command
+        :param commands: list
+        :return: list
+        """
+        combined = []
+        for command in commands:
+            parts = self.__package_parts__(command)
+            previous = self.__package_parts__(combined[-1]) if combined else None
+            if parts and previous:
+                if parts == previous and parts[1] == 'update' and not parts[3]:
+                    continue
+                if parts[:3] == previous[:3] and parts[1] in self.PACKAGE_ACTIONS and parts[3] and previous[3]:
+                    combined[-1] = f'{combined[-1]} {" ".join(parts[3])}'
+                    continue
+
+            combined.append(command)
+
+        return combined
+
+
+class EcrHelper:
+
+    __repository_name = None
+    __registry_id = None
+    __repository_uri = None
+    __docker_env = None
+    __application_name = None
+    __application_version_base = None
+    __application_version_current = None
+    __application_version_next = None
+    __docker_directory = None
+    __network = None
+    __network_name = None
+    __image_cache = None
+    __version_index = None
+    __ecr = None
+    __auth_file = None
+    __clients = {}
+    __clients_lock = threading.Lock()
+    __push_retries = None
+    __push_results = None
+    __push_slots = None
+    __push_slots_lock = threading.Lock()
+    __phase_timings = None
+    __docker_host = None
+
+    def __init__(self, input_helper, prune=False):
+        self.__ecr = self.__get_ecr_client__(input_helper.get_ecr_repository('PROFILE_NAME'),
+                                             input_helper.get_ecr_repository('ENDPOINT_URL', ''),
+                                             int(input_helper.get_ecr_repository('MAX_CONNECTIONS', '10')))
+        cache_directory = input_helper.get_build_cache('DIRECTORY', '.build_cache')
+        os.makedirs(cache_directory, exist_ok=True)
+        self.__auth_file = f'{cache_directory}{os.path.sep}ecr-auth-{{}}.json'
+        self.__push_retries = int(input_helper.get_build_options('PUSH_RETRIES', '3'))
+        self.__push_results = []
+        self.__get_push_slots__(int(input_helper.get_build_options('PUSH_CONCURRENCY', '2')))
+        self.__repository_name = input_helper.get_ecr_repository('NAME')
+        self.__application_name = input_helper.get_application('NAME')
+        self.__docker_directory = input_helper.get_application_image('DIRECTORY')
+        self.__network_name = input_helper.get_application_image('NETWORK_NAME')
+        self.__application_version_base = input_helper.get_application('BASE_VERSION').strip()
+        self.__application_version_current = self.__application_version_base
+        self.__version_index = VersionIndexHelper(input_helper, self.__repository_name)
+        self.__docker_host = input_helper.get_docker_host()
+        phases = PhaseRunner('ecr')
+        phases.add('docker', self.__connect_docker__)
+        phases.add('repository', self.get_create_repository)
+        phases.add('login', self.registry_login, requires=['docker', 'repository'])
+        phases.add('cache', lambda: self.__set_up_image_cache__(input_helper, prune), requires=['docker'])
+        phases.add('versions', self.registry_get_latest, requires=['repository'])
+        phases.add('network', self.__create_my_network__, requires=['cache'])
+        phases.run()
+        self.__phase_timings = phases.get_timings()
+
+    @classmethod
+    def __get_ecr_client__(cls, profile_name, endpoint_url, max_connections):
+        """
+        One ecr client per profile and endpoint, shared by every helper so connections are pooled.
+        Clients are thread safe, sessions are not, so the session only lives long enough to make the client.
+        :param profile_name: string
+        :param endpoint_url: string, empty for AWS, set to use a local stand in for ecr
+        :param max_connections: int
+        :return: client
+        """
+        import boto3
+        from botocore.config import Config
+
+        with cls.__clients_lock:
+            key = (profile_name, endpoint_url)
+            if key not in cls.__clients:
+                session = boto3.Session(profile_name=profile_name)
+                cls.__clients[key] = session.client(
+                    'ecr',
+                    endpoint_url=endpoint_url or None,
+                    config=Config(max_pool_connections=max_connections,
+                                  retries={'max_attempts': 5, 'mode': 'standard'})
+                )
+
+            return cls.__clients[key]
+
+    def get_repository(self):
+        """
+        Get ecr repository from AWS
+        :return: dict
+        """
+        found_repository = {}
+        try:
+            results = self.__ecr.describe_repositories(repositoryNames=[self.__repository_name])
+        except self.__ecr.exceptions.RepositoryNotFoundException:
+            return found_repository
+
+        if results.get('repositories'):
+            if len(results.get('repositories')) > 1:
+                sys.exit(f'Something wrong found multiple {self.__repository_name}: {results.get("repositories")}')
+            else:
+                found_repository = results.get('repositories')[-1]
+                if results.get('repositories')[-1].get('registryId'):
+                    self.__registry_id = results.get('repositories')[-1].get('registryId')
+                    self.__repository_uri = results.get('repositories')[-1].get('repositoryUri')
+
+        return found_repository
+
+    def get_repositories(self):
+        """
+        Get ecr repositories from AWS
+        :return: list of dict
+        """
+        found_repositories = []
+        keep_searching = True
+        next_token = None
+        while keep_searching:
+            if next_token:
+                results = self.__ecr.describe_repositories(nextToken=next_token)
+            else:
+                results = self.__ecr.describe_repositories()
+
+            if results:
+                if results.get('nextToken'):
+                    next_token = results.get('nextToken')
+                else:
+                    keep_searching = False
+
+                if results.get('repositories'):
+                    found_repositories.extend(results.get('repositories'))
+
+        return found_repositories
+
+    def create_repository(self):
+        """
+        Create ecr repository in AWS
+        :return: dict
+        """
+        new_repository = {}
+        try:
+            results = self.__ecr.create_repository(
+                repositoryName=self.__repository_name,
+                imageScanningConfiguration={
+                    'scanOnPush': True
+                },
+                imageTagMutability='IMMUTABLE',
+                encryptionConfiguration={
+                    'encryptionType': 'AES256'
+                }
+            )
+        except self.__ecr.exceptions.RepositoryAlreadyExistsException:
+            # Another build running at the same time created it first
+            return self.get_repository()
+
+        if results.get('repository'):
+            new_repository = results.get('repository')
+            if results.get('repository').get('registryId'):
+                self.__registry_id = results.get('repository').get('registryId')
+                self.__repository_uri = results.get('repository').get('repositoryUri')
+
+        return new_repository
+
+    def get_create_repository(self):
+        """
+        Get repository from ecr and if missing or not found create it
+        :return: dict
+        """
+        repository_lookup = self.get_repository()
+        if repository_lookup:
+            logging.warning(f'Repository {self.__repository_name} existed')
+            repository_info = repository_lookup
+        else:
+            logging.warning(f'Repository {self.__repository_name} created')
+            repository_info = self.create_repository()
+
+        return repository_info
+
+    def registry_login(self):
+        """
+        Log into ecr repository in aws
+        :return: None
+        """
+        logging.warning(f'Logging into registry {self.__repository_uri}')
         if self.__registry_id:
-            auth_request = self.__session.client('ecr').get_authorization_token(
-                registryIds=[self.__registry_id])
-            if auth_request.get('authorizationData'):
-                for auth_data in auth_request.get('authorizationData'):
-                    if auth_data.get('authorizationToken'):
-                        auth_token = auth_data.get('authorizationToken')
-                        auth_list = base64.b64decode(auth_token).decode('utf-8').split(':')
-                        auth_endpoint = auth_data.get('proxyEndpoint')
-                        self.__docker_env = docker.from_env()
-                        self.__docker_env.login(username=auth_list[0], password=auth_list[1], registry=auth_endpoint)
+            for auth_data in self.__get_authorization_data__():
+                if auth_data.get('authorizationToken'):
+                    auth_token = auth_data.get('authorizationToken')
+                    auth_list = base64.b64decode(auth_token).decode('utf-8').split(':')
+                    auth_endpoint = auth_data.get('proxyEndpoint')
+                    self.__docker_env.login(username=auth_list[0], password=auth_list[1], registry=auth_endpoint)
+
+    def registry_login_cli(self):
+        """
+        Log the docker cli into the ecr registry for builds that push through docker buildx
+        :return: None
+        """
+        if not self.__registry_id:
+            return
+
+        for auth_data in self.__get_authorization_data__():
+            auth_list = base64.b64decode(auth_data.get('authorizationToken')).decode('utf-8').split(':', 1)
+            login = subprocess.run(['docker', 'login', '--username', auth_list[0], '--password-stdin',
+                                    auth_data.get('proxyEndpoint')],
+                                   input=auth_list[1], capture_output=True, text=True)
+            if login.returncode != 0:
+                sys.exit(f'docker login to {auth_data.get("proxyEndpoint")} failed: {login.stderr.strip()}')
+
+    def __connect_docker__(self):
+        """
+        Connect to the docker daemon the job was scheduled on, the local one by default
+        :return: client
+        """
+        self.__docker_env = DockerHostPool.connect(self.__docker_host)
+        return self.__docker_env
+
+    def __set_up_image_cache__(self, input_helper, prune):
+        """
+        Prune everything local when asked to, otherwise evict the least recently used images.
+        Matrix jobs share the daemon with builds that are running, MatrixHelper evicts once before they start.
+        :param input_helper: InputHelper
+        :param prune: bool
+        :return: ImageCacheHelper
+        """
+        self.__image_cache = ImageCacheHelper(input_helper, self.__docker_env)
+        if prune:
+            self.registry_prune()
+        elif not input_helper.get_job_id():
+            self.__image_cache.evict()
+
+        return self.__image_cache
+
+    def __get_authorization_data__(self):
+        """
+        Get authorization data from the token cache, only asking ecr for a new token when the
+        cached one is missing or expires within 10 minutes
+        :return: list of dict
+        """
+        auth_file = self.__auth_file.format(self.__registry_id)
+        if os.path.exists(auth_file):
+            with open(auth_file, 'r') as in_:
+                cached = json.load(in_)
+            expires_at = datetime.datetime.fromisoformat(cached[0].get('expiresAt'))
+            if expires_at - datetime.timedelta(minutes=10) > datetime.datetime.now(datetime.timezone.utc):
+                return cached
+
+        auth_request = self.__ecr.get_authorization_token(registryIds=[self.__registry_id])
+        authorization_data = [
+            {'authorizationToken': a_.get('authorizationToken'),
+             'proxyEndpoint': a_.get('proxyEndpoint'),
+             'expiresAt': a_.get('expiresAt').astimezone(datetime.timezone.utc).isoformat()}
+            for a_ in auth_request.get('authorizationData', [])
+        ]
+        if authorization_data:
+            # mkstemp creates the file readable only by the current user, replacing the cache in one step
+            # means parallel builds never read a half written token
+            descriptor, temp_file = tempfile.mkstemp(dir=os.path.dirname(auth_file) or '.', suffix='.tmp')
+            with os.fdopen(descriptor, 'w') as out_:
+                json.dump(authorization_data, out_)
+            os.replace(temp_file, auth_file)
+
+        return authorization_data
 
     def __create_my_network__(self):
         """
-        Create a local bridge docker network for the image to utilize.
-        Without this issues with downloads and DNS lookups kept happening.
-        :return: network
+        Create a local bridge docker network for the image to utilize.
+        Without this issues with downloads and DNS lookups kept happening.
+        :return: network
+        """
+        # The names filter matches part of a name, my would also find my_job or an unrelated network
+        existing_networks = [n_ for n_ in self.__docker_env.networks.list(names=[self.__network_name])
+                             if n_.name == self.__network_name]
+        if existing_networks:
+            self.__network = existing_networks[0]
+            return self.__network
+
+        self.__network = self.__docker_env.networks.create(
+            name=self.__network_name,
+            driver='bridge',
+            internal=False,
+            scope='local',
+            enable_ipv6=False,
+        )
+        return self.__network
+
+    @classmethod
+    def __get_push_slots__(cls, push_concurrency):
+        """
+        Semaphore shared by every helper limiting how many pushes run at the same time
+        :param push_concurrency: int
+        :return: semaphore
+        """
+        with cls.__push_slots_lock:
+            if cls.__push_slots is None:
+                cls.__push_slots = threading.BoundedSemaphore(push_concurrency)
+
+            return cls.__push_slots
+
+    def registry_upload(self, image_name, pushed=None):
+        """
+        Upload image to the ERC registry, retrying with backoff when a layer fails.
+        Layers that made it are reported as already existing on the next attempt so only the
+        failed ones are sent again.
+        :param image_name: string
+        :param pushed: dict result of a push the build already did, only recorded
+        :return: dict of push results
+        """
+        from docker.errors import DockerException
+        from requests.exceptions import RequestException
+
+        if pushed:
+            result = dict(pushed, attempts=1)
+            self.__push_results.append(result)
+            self.__version_index.add(image_name.rsplit(':', 1)[-1])
+            return result
+
+        with self.__push_slots:
+            for attempt in range(1, self.__push_retries + 2):
+                try:
+                    result = self.__stream_push__(image_name)
+                    result['attempts'] = attempt
+                    break
+                # Dropped connections come from requests, not the builtin ConnectionError
+                except (DockerException, RequestException, ConnectionError, PushError) as pe:
+                    if attempt > self.__push_retries:
+                        sys.exit(f'Pushing {image_name} failed after {attempt} attempts: {pe}')
+                    logging.warning(f'Pushing {image_name} failed, retrying in {2 ** attempt}s: {pe}')
+                    time.sleep(2 ** attempt)
+
+        self.__push_results.append(result)
+        self.__version_index.add(image_name.rsplit(':', 1)[-1])
+        return result
+
+    def __stream_push__(self, image_name):
+        """
+        Push through the low level api, logging each layer as it changes state and the throughput
+        :param image_name: string
+        :return: dict
+        """
+        logging.warning(f'Pushing {image_name}')
+        repository, tag = image_name.rsplit(':', 1)
+        layers = {}
+        logged = {}
+        digest = None
+        started = time.time()
+        for chunk in self.__docker_env.api.push(repository, tag=tag, stream=True, decode=True):
+            if chunk.get('error'):
+                raise PushError(chunk.get('error'))
+
+            if chunk.get('aux', {}).get('Digest'):
+                digest = chunk.get('aux').get('Digest')
+
+            layer = chunk.get('id')
+            status = chunk.get('status', '')
+            if not layer or layer == tag:
+                continue
+
+            progress = chunk.get('progressDetail') or {}
+            state = layers.setdefault(layer, {'status': None, 'current': 0, 'total': 0})
+            if progress.get('total'):
+                state['current'] = progress.get('current', 0)
+                state['total'] = progress.get('total')
+            if status == 'Pushed' and state['total']:
+                state['current'] = state['total']
+
+            percent = int(100 * state['current'] / state['total']) // 25 * 25 if state['total'] else 0
+            if state['status'] != status or (status == 'Pushing' and logged.get(layer) != percent):
+                state['status'] = status
+                logged[layer] = percent
+                sent = sum(s_['current'] for s_ in layers.values())
+                elapsed = max(time.time() - started, 0.001)
+                progress_text = f' {percent}%' if status == 'Pushing' else ''
+                logging.warning(f'{image_name} {layer}: {status}{progress_text} '
+                                f'({round(sent / (1024 * 1024), 2)}MB at '
+                                f'{round(sent / (1024 * 1024) / elapsed, 2)}MB/s)')
+
+        result = {
+            'image': image_name,
+            'digest': digest,
+            'seconds': round(time.time() - started, 3),
+            'bytes': sum(s_['current'] for s_ in layers.values() if s_['status'] == 'Pushed'),
+            'layers': len(layers),
+            'layers_pushed': len([s_ for s_ in layers.values() if s_['status'] == 'Pushed']),
+        }
+        logging.warning(f'Pushed {image_name} {digest}: {result["layers_pushed"]} of {result["layers"]} layers, '
+                        f'{round(result["bytes"] / (1024 * 1024), 2)}MB in {result["seconds"]}s')
+        return result
+
+    def registry_get_latest(self):
+        """
+        Set the next value from the local version index, only listing ecr when the index is cold
+        or the next version turns out to already exist
+        :return: None
+        """
+        versions = self.__version_index.get_versions(self.__application_name)
+        if versions is None or self.__tag_exists__(self.__next_version__(versions)):
+            versions = self.registry_refresh_versions()
+
+        self.__application_version_next = self.__next_version__(versions)
+
+    def registry_refresh_versions(self):
+        """
+        List every tag in the ecr repository and rebuild the version index from it
+        :return: list of versions for this application
+        """
+        ecr_tags = []
+        ecr_keep_searching = True
+        ecr_next_token = None
+        logging.warning(f'Fetching images from {self.__repository_name}')
+        while ecr_keep_searching:
+            if ecr_next_token:
+                results = self.__ecr.list_images(
+                    repositoryName=self.__repository_name,
+                    filter={'tagStatus': 'TAGGED'},
+                    nextToken=ecr_next_token
+                )
+            else:
+                results = self.__ecr.list_images(
+                    repositoryName=self.__repository_name,
+                    filter={'tagStatus': 'TAGGED'}
+                )
+
+            if results.get('nextToken'):
+                ecr_next_token = results.get('nextToken')
+            else:
+                ecr_keep_searching = False
+
+            if results.get('imageIds'):
+                ecr_tags.extend(image.get('imageTag') for image in results.get('imageIds'))
+
+        self.__version_index.replace(ecr_tags)
+        return self.__version_index.get_versions(self.__application_name) or []
+
+    def __next_version__(self, versions):
+        """
+        Work out current and next version from existing versions of this application.
+        Versions below the base version are ignored, the last part of the current version is incremented.
+        :param versions: list
+        :return: string
+        """
+        base = VersionIndexHelper.version_key(self.__application_version_base)
+        newer = [v_ for v_ in versions or [] if VersionIndexHelper.version_key(v_) >= base]
+        if not newer:
+            self.__application_version_current = self.__application_version_base
+            return self.__application_version_base
+
+        self.__application_version_current = max(newer, key=VersionIndexHelper.version_key)
+        parts = self.__application_version_current.split('.')
+        parts[-1] = f'{int(parts[-1]) + 1}'
+        return '.'.join(parts)
+
+    def __tag_exists__(self, version):
+        """
+        Check if this application version is already in ecr
+        :param version: string
+        :return: bool
+        """
+        try:
+            results = self.__ecr.describe_images(
+                repositoryName=self.__repository_name,
+                imageIds=[{'imageTag': f'{self.__application_name}-{version}'}]
+            )
+        except self.__ecr.exceptions.ImageNotFoundException:
+            return False
+
+        return bool(results.get('imageDetails'))
+
+    def registry_find_build(self, build_hash):
+        """
+        Check if the latest image in ECR for this application was built from the same build hash.
+        Only the manifest and config blob are fetched, the image is not pulled.
+        :param build_hash: string
+        :return: string image_name or None
+        """
+        if self.__application_version_current == self.__application_version_next:
+            return None
+
+        image_tag = f'{self.__application_name}-{self.__application_version_current}'
+        results = self.__ecr.batch_get_image(
+            repositoryName=self.__repository_name,
+            imageIds=[{'imageTag': image_tag}],
+            acceptedMediaTypes=['application/vnd.docker.distribution.manifest.v2+json']
+        )
+        if not results.get('images'):
+            return None
+
+        manifest = json.loads(results.get('images')[0].get('imageManifest'))
+        if not manifest.get('config'):
+            return None
+
+        download = self.__ecr.get_download_url_for_layer(
+            repositoryName=self.__repository_name,
+            layerDigest=manifest.get('config').get('digest')
+        )
+        with urllib.request.urlopen(download.get('downloadUrl')) as response:
+            image_config = json.load(response)
+
+        labels = image_config.get('config', {}).get('Labels') or {}
+        if labels.get('BuildHash') == build_hash:
+            logging.warning(f'Build hash {build_hash} matched {self.__repository_uri}:{image_tag}')
+            return f'{self.__repository_uri}:{image_tag}'
+
+        return None
+
+    def registry_prune(self):
+        """
+        Remove any local docker containers, images, networks to prevent cache issues.
+        Only used when a full prune is explicitly requested, otherwise the image cache evicts.
+        :return: None
+        """
+        logging.warning(f'Cleaning up local repository')
+        self.__docker_env.containers.prune()
+        self.__docker_env.images.prune()
+        self.__docker_env.networks.prune()
+
+    def get_repository_uri(self):
+        return self.__repository_uri
+
+    def get_application_version_next(self):
+        return self.__application_version_next
+
+    def get_docker_env(self):
+        return self.__docker_env
+
+    def get_network(self):
+        return self.__network
+
+    def get_image_cache(self):
+        return self.__image_cache
+
+    def get_push_results(self):
+        return self.__push_results
+
+    def get_phase_timings(self):
+        return self.__phase_timings
+
+
+class PushError(Exception):
+    """
+    Raised when the registry reports an error part way through a push.
+    """
+
+
+class BuildCancelled(Exception):
+    """
+    Raised in the thread running a build when DockerHelper.cancel stopped it.
+    """
+
+
+class ImageCacheHelper:
+    """
+    Keep images built by this tool between runs and evict the least recently used ones
+    once the disk budget or maximum age is exceeded.
+    """
+
+    __docker_env = None
+    __state_file = None
+    __max_size = None
+    __max_age = None
+    __lock = threading.Lock()
+
+    def __init__(self, input_helper, docker_env):
+        self.__docker_env = docker_env
+        cache_directory = input_helper.get_build_cache('DIRECTORY', '.build_cache')
+        os.makedirs(cache_directory, exist_ok=True)
+        docker_host = input_helper.get_docker_host()
+        # Each daemon has its own images so each one gets its own state
+        host_suffix = f'-{hashlib.sha1(docker_host.encode("utf-8")).hexdigest()[:12]}' if docker_host else ''
+        self.__state_file = f'{cache_directory}{os.path.sep}images{host_suffix}.json'
+        self.__max_size = int(input_helper.get_build_cache('MAX_SIZE_MB', '20480')) * 1024 * 1024
+        self.__max_age = float(input_helper.get_build_cache('MAX_AGE_DAYS', '14')) * 24 * 60 * 60
+
+    def touch(self, image_id):
+        """
+        Record that the image was just built or reused
+        :param image_id: string
+        :return: None
+        """
+        with self.__lock:
+            state = self.__read_state__()
+            state[image_id] = time.time()
+            self.__write_state__(state)
+
+    def evict(self):
+        """
+        Remove images labeled by this tool that are older than the maximum age or push the total past
+        the size budget. Base images, dangling images and containers are never touched, they may belong
+        to builds still running or to other tools, --prune removes those.
+        Sizes include shared layers so the budget errs on the side of evicting.
+        :return: list of removed image ids
+        """
+        from docker.errors import APIError
+
+        logging.warning(f'Evicting local images over {self.__max_size // (1024 * 1024)}MB '
+                        f'or older than {self.__max_age // (24 * 60 * 60)} days')
+
+        removed = []
+        now = time.time()
+        with self.__lock:
+            state = self.__read_state__()
+            images = self.__docker_env.images.list(filters={'label': 'Application'})
+            images.sort(key=lambda image_: state.get(image_.id, self.__created__(image_)), reverse=True)
+            total_size = 0
+            for image in images:
+                last_used = state.get(image.id, self.__created__(image))
+                total_size += image.attrs.get('Size', 0)
+                if now - last_used > self.__max_age or total_size > self.__max_size:
+                    try:
+                        self.__docker_env.images.remove(image.id, force=True)
+                        removed.append(image.id)
+                        total_size -= image.attrs.get('Size', 0)
+                        logging.warning(f'Evicted {image.id} {image.tags}')
+                    except APIError as ae:
+                        logging.warning(f'Could not evict {image.id}: {ae}')
+
+            present = set(image.id for image in images) - set(removed)
+            self.__write_state__({k: v for k, v in state.items() if k in present})
+
+        return removed
+
+    @staticmethod
+    def __created__(image):
+        """
+        Creation time of image, used when it was never recorded as used, e.g. built by another job
+        :param image: image
+        :return: float
+        """
+        created = image.attrs.get('Created', '')[:19]
+        if not created:
+            return 0
+
+        return datetime.datetime.strptime(created, '%Y-%m-%dT%H:%M:%S').replace(
+            tzinfo=datetime.timezone.utc).timestamp()
+
+    def __read_state__(self):
+        """
+        Read image id to last used time map
+        :return: dict
+        """
+        if os.path.exists(self.__state_file):
+            with open(self.__state_file, 'r') as in_:
+                return json.load(in_)
+
+        return {}
+
+    def __write_state__(self, state):
+        """
+        Write image id to last used time map
+        :param state: dict
+        :return: None
+        """
+        with open(f'{self.__state_file}.tmp', 'w') as out_:
+            json.dump(state, out_, indent=2)
+        os.replace(f'{self.__state_file}.tmp', self.__state_file)
+
+
+class ImageSizeHelper:
+    """
+    Attribute the layers of a built image to the items and Dockerfile lines that made them and check
+    the sizes against the budgets in the image_size section.
+    """
+
+    __budgets = None
+    __total_budget = None
+    __item_budget = None
+    __fail = False
+
+    def __init__(self, input_helper):
+        budgets = input_helper.get_sections().get('image_size', {})
+        self.__fail = budgets.pop('ACTION', 'warn') == 'fail'
+        self.__total_budget = self.__to_bytes__(budgets.pop('TOTAL_MB', ''))
+        self.__item_budget = self.__to_bytes__(budgets.pop('ITEM_MB', ''))
+        self.__budgets = {item_.lower(): self.__to_bytes__(mb_) for item_, mb_ in budgets.items()}
+
+    def analyze(self, docker_env, image_id, current_directory):
+        """
+        Read the history of the image, map each layer to the instruction of the Dockerfile that made it,
+        write size-report.json in the build directory and check the budgets
+        :param docker_env: client
+        :param image_id: string
+        :param current_directory: string
+        :return: dict
+        """
+        with open(f'{current_directory}{os.path.sep}Dockerfile', 'r') as in_:
+            instructions, parent = self.__final_stage__(DockerfileOptimizer.parse_instructions(in_.readlines()))
+
+        history = list(reversed(docker_env.images.get(image_id).history()))
+        from docker.errors import APIError
+
+        parent_layers = 0
+        try:
+            parent_layers = len(docker_env.images.get(parent).history())
+        except APIError as ae:
+            logging.warning(f'Could not read the history of {parent}, matching all layers: {ae}')
+
+        layers = []
+        position = 0
+        for index, layer_ in enumerate(history):
+            created_by = layer_.get('CreatedBy') or ''
+            item = '(parent)' if index < parent_layers else '(other)'
+            line = None
+            if index >= parent_layers:
+                for offset_, (instruction_, arguments_, items_) in enumerate(instructions[position:]):
+                    if self.__matches__(instruction_, arguments_, created_by):
+                        item = ','.join(items_) or '(stage)'
+                        line = f'{instruction_} {arguments_}'
+                        position += offset_ + 1
+                        break
+            layers.append({'item': item, 'instruction': line or created_by.strip(), 'size': layer_.get('Size', 0)})
+
+        items = {}
+        for layer_ in layers:
+            items[layer_.get('item')] = items.get(layer_.get('item'), 0) + layer_.get('size')
+        report = {
+            'image': image_id,
+            'size': sum(l_.get('size') for l_ in layers),
+            'items': dict(sorted(items.items(), key=lambda i_: i_[1], reverse=True)),
+            'layers': layers,
+        }
+        with open(f'{current_directory}{os.path.sep}size-report.json', 'w') as out_:
+            json.dump(report, out_, indent=2)
+
+        for item_, size_ in report.get('items').items():
+            logging.warning(f'{item_:<30} {size_ / (1024 * 1024):>10.1f}MB')
+        logging.warning(f'{"total":<30} {report.get("size") / (1024 * 1024):>10.1f}MB')
+
+        self.__check_budgets__(report)
+        return report
+
+    def __check_budgets__(self, report):
+        """
+        Warn, or stop when ACTION is fail, when the image or an item is over its budget
+        :param report: dict
+        :return: list of exceeded budgets
+        """
+        exceeded = []
+        if self.__total_budget is not None and report.get('size') > self.__total_budget:
+            exceeded.append(f'image is {report.get("size") // (1024 * 1024)}MB, '
+                            f'over its budget of {self.__total_budget // (1024 * 1024)}MB')
+        for item_, size_ in report.get('items').items():
+            budget = self.__budgets.get(item_, self.__item_budget)
+            if item_.startswith('(') or budget is None:
+                continue
+            if size_ > budget:
+                exceeded.append(f'{item_} is {size_ // (1024 * 1024)}MB, over its budget of {budget // (1024 * 1024)}MB')
+
+        for exceeded_ in exceeded:
+            logging.warning(exceeded_)
+        if exceeded and self.__fail:
+            sys.exit(f'Image size budgets exceeded: {"; ".join(exceeded)}')
+
+        return exceeded
+
+    @staticmethod
+    def __final_stage__(instructions):
+        """
+        Instructions of the final stage, including those of the stages it is built from, and the
+        parent image the first of those stages starts from
+        :param instructions: list of parsed instructions
+        :return: tuple of list and string
+        """
+        stages = {}
+        stage = None
+        for instruction, arguments, items in instructions:
+            if instruction == 'FROM':
+                parts = arguments.split()
+                stage = {'from': parts[0], 'instructions': []}
+                stages[parts[-1].lower() if len(parts) > 2 and parts[-2].lower() == 'as' else None] = stage
+                continue
+            stage.get('instructions').append((instruction, arguments, items))
+
+        chain = stage.get('instructions')
+        while stage.get('from').lower() in stages:
+            stage = stages.get(stage.get('from').lower())
+            chain = stage.get('instructions') + chain
+
+        return chain, stage.get('from')
+
+    @staticmethod
+    def __matches__(instruction, arguments, created_by):
+        """
+        Check if a history entry was created by an instruction, comparing without quotes, escapes,
+        repeated spaces or flags such as cache mounts that history leaves out
+        :param instruction: string
+        :param arguments: string
+        :param created_by: string
+        :return: bool
+        """
+        def normalize_(text_):
+            return ' '.join(text_.replace('"', '').replace("'", '').replace('\\', '').split())
+
+        words = arguments.split()
+        while words and words[0].startswith('--'):
+            words.pop(0)
+        created = normalize_(created_by)
+        if instruction in ('COPY', 'ADD'):
+            return bool(words) and instruction in created and normalize_(words[-1]) in created
+        return normalize_(' '.join(words)) in created
+
+    @staticmethod
+    def __to_bytes__(mb_):
+        """
+        Convert a budget in MB to bytes
+        :param mb_: string, empty for no budget
+        :return: int or None
+        """
+        if not mb_ or not mb_.strip():
+            return None
+
+        return int(float(mb_) * 1024 * 1024)
+
+
+class ParentPinHelper:
+    """
+    Pin the PARENT_NAME images to the digest their tag resolved to the first time, recorded in a lock
+    file so every build uses the same parent until the lock is updated. The pinned parents are pulled
+    in the background so the download overlaps the clone and ecr set up.
+    """
+
+    __lock_file = None
+    __update = False
+    __parents = None
+    __pins = None
+    __docker_env = None
+    __pull_thread = None
+    __pull_error = None
+    __docker_host = None
+    __lock = threading.Lock()
+
+    def __init__(self, input_helper, update=False):
+        self.__lock_file = input_helper.get_build_options('PARENT_LOCK', 'parents.lock')
+        self.__update = update
+        self.__docker_host = input_helper.get_docker_host()
+        self.__parents = []
+        for parent_ in [input_helper.get_application_build('PARENT_NAME'),
+                        input_helper.get_application_image('PARENT_NAME')]:
+            if parent_ not in self.__parents:
+                self.__parents.append(parent_)
+        self.__pins = {}
+
+    def pin(self, resolve=True):
+        """
+        Get the pinned reference of each parent, resolving tags missing from the lock file, or all
+        of them when the lock is being updated, against the registry
+        :param resolve: bool, when false only parents already in the lock file are pinned
+        :return: dict of parent name to name@digest
         """
-        self.__network = self.__docker_env.networks.create(
-            name=self.__network_name,
-            driver='bridge',
-            internal=False,
-            scope='local',
-            enable_ipv6=False,
-        )
-
-    def registry_upload(self, image_name):
+        with self.__lock:
+            locked = self.__read_lock__()
+            changed = False
+            for parent_ in self.__parents:
+                if '@' in parent_:
+                    self.__pins[parent_] = parent_
+                    continue
+                if not resolve:
+                    if parent_ in locked:
+                        self.__pins[parent_] = f'{parent_}@{locked[parent_]}'
+                    else:
+                        logging.warning(f'{parent_} is not in {self.__lock_file}, using it unpinned')
+                    continue
+                if self.__update or parent_ not in locked:
+                    digest = self.__get_docker_env__().images.get_registry_data(parent_).id
+                    if locked.get(parent_) != digest:
+                        logging.warning(f'Pinned {parent_} to {digest}')
+                        locked[parent_] = digest
+                        changed = True
+                self.__pins[parent_] = f'{parent_}@{locked[parent_]}'
+            if changed:
+                self.__write_lock__(locked)
+
+        return self.__pins
+
+    def pull(self):
         """
-        Upload image to the ERC registry
-        :param image_name: string
+        Start pulling the pinned parents that are not already local in the background
         :return: None
         """
-        logging.warning(f'Pushing {image_name}')
-        results = self.__docker_env.images.push(image_name)
-        push_lines = results.split('\r\n')
-        logging.warning(f'Pushing results: {push_lines[len(push_lines) - 2]}')
+        if self.__pull_thread or not self.__pins:
+            return
 
-    def registry_get_latest(self):
+        self.__pull_thread = threading.Thread(target=self.__pull_parents__, name='parents', daemon=True)
+        self.__pull_thread.start()
+
+    def wait(self):
         """
-        Set the next value based on search of ecr repository
+        Wait for the background pull, a failed pull is left for the build to retry
         :return: None
         """
-        ecr_images = []
-        ecr_keep_searching = True
-        ecr_next_token = None
-        logging.warning(f'Fetching images from {self.__repository_name}')
-        while ecr_keep_searching:
-            if ecr_next_token:
-                results = self.__session.client('ecr').list_images(
-                    repositoryName=self.__repository_name,
-                    nextToken=ecr_next_token
-                )
-            else:
-                results = self.__session.client('ecr').list_images(
-                    repositoryName=self.__repository_name
-                )
-
-            if results.get('nextToken'):
-                ecr_next_token = results.get('nextToken')
-            else:
-                ecr_keep_searching = False
+        if self.__pull_thread:
+            self.__pull_thread.join()
+            self.__pull_thread = None
+        if self.__pull_error:
+            logging.warning(f'Pulling parents failed, the build will pull them: {self.__pull_error}')
+            self.__pull_error = None
 
-            if results.get('imageIds'):
-                ecr_images.extend(results.get('imageIds'))
-
-        use_base = True
-        if ecr_images:
-            for image in ecr_images:
-                image_version = round(float(image.get('imageTag').split('-')[-1]), 4)
-                if image_version >= self.__application_version_current:
-                    self.__application_version_current = image_version
-                    use_base = False
-
-        if self.__application_version_current == self.__application_version_base and use_base:
-            self.__application_version_next = round(float(self.__application_version_current), 4)
-        else:
-            self.__application_version_next = round(float(self.__application_version_current + 0.1), 4)
+    def get_pins(self):
+        return self.__pins
 
-    def registry_prune(self):
+    def __pull_parents__(self):
         """
-        Remove any local docker containers, images, networks to prevent cache issues.
+        Pull every pinned parent by digest
         :return: None
         """
-        logging.warning(f'Cleaning up local repository')
-        self.__docker_env.containers.prune()
-        self.__docker_env.images.prune()
-        self.__docker_env.networks.prune()
+        from docker.errors import ImageNotFound
+        from docker.utils import parse_repository_tag
 
-    def get_repository_uri(self):
-        return self.__repository_uri
+        try:
+            docker_env = self.__get_docker_env__()
+            for pinned_ in set(self.__pins.values()):
+                repository, digest = pinned_.split('@', 1)
+                repository = parse_repository_tag(repository)[0]
+                try:
+                    docker_env.images.get(f'{repository}@{digest}')
+                    continue
+                except ImageNotFound:
+                    pass
+                started = time.monotonic()
+                docker_env.images.pull(repository, tag=digest)
+                logging.warning(f'Pulled {pinned_} in {time.monotonic() - started:.1f}s')
+        except BaseException as be:
+            self.__pull_error = be
+
+    def __get_docker_env__(self):
+        if not self.__docker_env:
+            self.__docker_env = DockerHostPool.connect(self.__docker_host)
+        return self.__docker_env
 
-    def get_application_version_next(self):
-        return self.__application_version_next
+    def __read_lock__(self):
+        """
+        Read parent name to digest map
+        :return: dict
+        """
+        if os.path.exists(self.__lock_file):
+            with open(self.__lock_file, 'r') as in_:
+                return json.load(in_)
 
-    def get_docker_env(self):
-        return self.__docker_env
+        return {}
 
-    def get_network(self):
-        return self.__network
+    def __write_lock__(self, locked):
+        """
+        Write parent name to digest map, sorted so it diffs well when committed
+        :param locked: dict
+        :return: None
+        """
+        with open(f'{self.__lock_file}.tmp', 'w') as out_:
+            json.dump(locked, out_, indent=2, sort_keys=True)
+            out_.write('\n')
+        os.replace(f'{self.__lock_file}.tmp', self.__lock_file)
 
 
 class GitHelper:
@@ -622,12 +2993,26 @@ class GitHelper:
     __git_folder = None
     __repo = None
     __branch = None
+    __build_folder = None
+    __mirror_folder = None
+    __sparse = False
+    __filter = None
+    __remote_commit = None
+    __mirror_locks = {}
+    __mirror_locks_lock = threading.Lock()
 
     def __init__(self, input_helper):
         self.__url = input_helper.get_application_build('URL')
         self.__git_folder = f'{input_helper.get_application_build("MULTI_DIRECTORY")}{os.path.sep}code'
-        self.__reset_git_folder__(self.__git_folder)
+        os.makedirs(self.__git_folder, exist_ok=True)
         self.__branch = input_helper.get_application_build('BRANCH')
+        self.__build_folder = input_helper.get_application_build('BUILD_FOLDER').strip('/')
+        if strtobool(input_helper.get_build_options('GIT_CACHE', 'false')):
+            url_hash = hashlib.sha1(self.__url.encode('utf-8')).hexdigest()
+            cache_directory = input_helper.get_build_cache('DIRECTORY', '.build_cache')
+            self.__mirror_folder = os.path.abspath(f'{cache_directory}{os.path.sep}git{os.path.sep}{url_hash}.git')
+        self.__sparse = strtobool(input_helper.get_build_options('GIT_SPARSE', 'false'))
+        self.__filter = input_helper.get_build_options('GIT_FILTER', '')
 
     @staticmethod
     def __reset_git_folder__(build_):
@@ -643,14 +3028,129 @@ class GitHelper:
 
     def clone_git(self):
         """
-        Checkout code into local directory
+        Checkout code into local directory, updating the existing clone in place when it is from the same url
         :return: repo
         """
+        from git import Repo
+
+        if self.__mirror_folder:
+            return self.__checkout_from_mirror__()
+
+        if os.path.isdir(f'{self.__git_folder}{os.path.sep}.git'):
+            repo = Repo(self.__git_folder)
+            if repo.remotes and repo.remotes.origin.url == self.__url:
+                logging.warning(f'Updating {self.__git_folder} from {self.__url} branch {self.__branch}')
+                repo.git.fetch('--depth=1', 'origin', self.__branch)
+                repo.git.reset('--hard', 'FETCH_HEAD')
+                repo.git.clean('-ffdx')
+                self.__repo = repo
+                return self.__repo
+
+        self.__reset_git_folder__(self.__git_folder)
         logging.warning(f'Cloning from {self.__url} branch {self.__branch} into {self.__git_folder}')
-        return Repo.clone_from(self.__url,
-                               self.__git_folder,
-                               depth=1,
-                               branch=self.__branch)
+        self.__repo = Repo.clone_from(self.__url,
+                                      self.__git_folder,
+                                      depth=1,
+                                      branch=self.__branch)
+        return self.__repo
+
+    def __get_mirror_lock__(self):
+        """
+        Lock shared by every helper using the same mirror so fetches and worktree changes do not overlap
+        :return: lock
+        """
+        with self.__mirror_locks_lock:
+            return self.__mirror_locks.setdefault(self.__mirror_folder, threading.Lock())
+
+    def __update_mirror__(self):
+        """
+        Create the bare mirror of the url on first use, afterwards only fetch the branch.
+        Commands run inside the mirror folder rather than through Repo as sparse worktrees move
+        core.bare into config.worktree, which Repo does not read.
+        :return: git
+        """
+        from git import Git, Repo
+
+        if os.path.exists(self.__mirror_folder):
+            logging.warning(f'Fetching {self.__url} branch {self.__branch} into {self.__mirror_folder}')
+        else:
+            logging.warning(f'Creating mirror of {self.__url} in {self.__mirror_folder}')
+            os.makedirs(os.path.dirname(self.__mirror_folder), exist_ok=True)
+            clone_options = {'bare': True, 'no_checkout': True}
+            if self.__filter:
+                clone_options['filter'] = self.__filter
+            Repo.clone_from(self.__url, self.__mirror_folder, **clone_options)
+
+        mirror = Git(self.__mirror_folder)
+        mirror.fetch('origin', f'+refs/heads/{self.__branch}:refs/heads/{self.__branch}')
+        return mirror
+
+    def __checkout_from_mirror__(self):
+        """
+        Check out the branch from the mirror into the code folder as a worktree.
+        With GIT_SPARSE only BUILD_FOLDER, the gradle wrapper and files at the root are checked out.
+        With GIT_FILTER the mirror is a partial clone and missing blobs are fetched when checked out.
+        :return: repo
+        """
+        from git import Repo
+
+        with self.__get_mirror_lock__():
+            mirror = self.__update_mirror__()
+            commit = mirror.rev_parse(f'refs/heads/{self.__branch}')
+            git_file = f'{self.__git_folder}{os.path.sep}.git'
+            worktree_of_mirror = False
+            if os.path.isfile(git_file):
+                with open(git_file, 'r') as in_:
+                    worktree_of_mirror = in_.read().strip().startswith(f'gitdir: {self.__mirror_folder}')
+
+            if not worktree_of_mirror:
+                logging.warning(f'Adding worktree {self.__git_folder} from {self.__mirror_folder}')
+                self.__reset_git_folder__(self.__git_folder)
+                os.rmdir(self.__git_folder)
+                mirror.worktree('prune')
+                mirror.worktree('add', '--detach', '--no-checkout', '--force',
+                                    os.path.abspath(self.__git_folder), commit)
+
+            repo = Repo(self.__git_folder)
+            if self.__sparse and self.__build_folder not in ('', '.'):
+                repo.git.sparse_checkout('set', '--cone', self.__build_folder, 'gradle')
+            else:
+                repo.git.sparse_checkout('disable')
+
+            logging.warning(f'Checking out {commit} of {self.__branch} into {self.__git_folder}')
+            repo.git.reset('--hard', commit)
+            repo.git.clean('-ffdx')
+
+        self.__repo = repo
+        return self.__repo
+
+    def get_git_folder(self):
+        return self.__git_folder
+
+    def get_commit(self):
+        """
+        Commit sha of the cloned code, or of the branch on the remote if nothing was cloned
+        :return: string
+        """
+        if self.__repo:
+            return self.__repo.head.commit.hexsha
+
+        return self.__remote_commit
+
+    def get_remote_commit(self):
+        """
+        Commit sha of the branch on the remote without cloning
+        :return: string
+        """
+        from git import Git
+
+        refs = Git().ls_remote(self.__url, f'refs/heads/{self.__branch}')
+        if not refs:
+            sys.exit(f'Branch {self.__branch} not found in {self.__url}')
+
+        self.__remote_commit = refs.split()[0]
+        logging.warning(f'Branch {self.__branch} of {self.__url} is at {self.__remote_commit}')
+        return self.__remote_commit
 
     def __switch_branch__(self):
         """
@@ -658,3 +3158,824 @@ class GitHelper:
         :return: None
         """
         self.__repo.git.checkout(self.__branch)
+
+
+class PhaseRunner:
+    """
+    Run named phases on a pool of threads, each one as soon as the phases it requires have finished.
+    The time each phase took is kept so the overlap can be seen in the log.
+    """
+
+    __name = None
+    __phases = None
+    __timings = None
+
+    def __init__(self, name):
+        self.__name = name
+        self.__phases = {}
+        self.__timings = {}
+
+    def add(self, phase_name, function, requires=None):
+        """
+        Add a phase, the phases it requires have to be added first
+        :param phase_name: string
+        :param function: callable taking no arguments
+        :param requires: list of phase names
+        :return: None
+        """
+        requires = requires or []
+        for required_ in requires:
+            if required_ not in self.__phases:
+                sys.exit(f'Phase {phase_name} requires {required_} which has not been added')
+
+        self.__phases[phase_name] = (function, requires)
+
+    def run(self):
+        """
+        Run every phase and wait for all of them, a failed phase fails the phases that require it
+        :return: dict of phase name to what the phase returned
+        """
+        results = {}
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=max(len(self.__phases), 1), thread_name_prefix=self.__name) as executor:
+            futures = {}
+            for phase_name_, (function_, requires_) in self.__phases.items():
+                futures[phase_name_] = executor.submit(self.__run_phase__, phase_name_, function_,
+                                                       [futures.get(r_) for r_ in requires_])
+
+            for phase_name_, future_ in futures.items():
+                results[phase_name_] = future_.result()
+
+        logging.warning(f'{self.__name} finished in {time.monotonic() - started:.1f}s, '
+                        f'its phases took {sum(self.__timings.values()):.1f}s together')
+        return results
+
+    def __run_phase__(self, phase_name, function, required):
+        """
+        Wait for the required phases then run and time one phase
+        :param phase_name: string
+        :param function: callable
+        :param required: list of futures
+        :return: what the phase returned
+        """
+        for future_ in required:
+            future_.result()
+
+        started = time.monotonic()
+        try:
+            return function()
+        finally:
+            self.__timings[phase_name] = time.monotonic() - started
+            logging.warning(f'{self.__name} phase {phase_name} took {self.__timings[phase_name]:.1f}s')
+
+    def get_timings(self):
+        return self.__timings
+
+
+class MetricsHelper:
+    """
+    Collect how long every phase of one build took with its step, context, size and push numbers and
+    write them to the METRICS_DIRECTORY, as an OpenMetrics text file for a textfile collector and
+    as a line of builds.jsonl to chart builds over time.
+    """
+
+    __directory = None
+    __application_name = None
+    __job_id = None
+    __phases = None
+    __build_report = None
+    __size_report = None
+    __push_results = None
+    __reused = False
+
+    def __init__(self, input_helper):
+        self.__directory = input_helper.get_build_options('METRICS_DIRECTORY', 'metrics')
+        self.__application_name = input_helper.get_application('NAME')
+        self.__job_id = input_helper.get_job_id()
+        self.__phases = {}
+        self.__push_results = []
+
+    def timed(self, phase_name, function):
+        """
+        Run and time one phase
+        :param phase_name: string
+        :param function: callable taking no arguments
+        :return: what the phase returned
+        """
+        started = time.monotonic()
+        try:
+            return function()
+        finally:
+            self.__phases[phase_name] = round(time.monotonic() - started, 3)
+
+    def add_phases(self, timings, prefix=''):
+        """
+        Add phases timed somewhere else, such as by a PhaseRunner
+        :param timings: dict of phase name to seconds
+        :param prefix: string put in front of each phase name
+        :return: None
+        """
+        for phase_name_, seconds_ in timings.items():
+            self.__phases[f'{prefix}{phase_name_}'] = round(seconds_, 3)
+
+    def set_build(self, docker_build, reused=False):
+        """
+        Take the build and size reports of the build that just ran
+        :param docker_build: DockerHelper
+        :param reused: bool the build was skipped for an image with the same build hash
+        :return: None
+        """
+        self.__build_report = docker_build.get_build_report()
+        self.__size_report = docker_build.get_size_report()
+        self.__reused = reused
+
+    def add_push(self, result):
+        self.__push_results.append(result)
+
+    def write(self, image_tag, succeeded):
+        """
+        Write the metrics of the build, the text file is replaced and the json line appended
+        :param image_tag: string
+        :param succeeded: bool
+        :return: dict the json line, None when METRICS_DIRECTORY is empty
+        """
+        if not self.__directory:
+            return None
+
+        steps = (self.__build_report or {}).get('steps') or []
+        cached = len([s_ for s_ in steps if s_.get('cached')])
+        context = (self.__build_report or {}).get('context') or {}
+        record = {
+            'time': datetime.datetime.now().isoformat(),
+            'application': self.__application_name,
+            'job': self.__job_id,
+            'image': image_tag,
+            'succeeded': bool(succeeded),
+            'reused': self.__reused,
+            'phases': self.__phases,
+            'build_seconds': (self.__build_report or {}).get('seconds'),
+            'steps': {'cached': cached, 'executed': len(steps) - cached,
+                      'cache_hit_ratio': round(cached / len(steps), 3) if steps else None},
+            'step_seconds': [{k_: s_.get(k_) for k_ in ('step', 'stage', 'items', 'cached', 'seconds')}
+                             for s_ in steps],
+            'context_bytes': context.get('bytes'),
+            'context_files': context.get('files'),
+            'image_size_bytes': (self.__size_report or {}).get('size'),
+            'pushed_bytes': sum(r_.get('bytes') or 0 for r_ in self.__push_results) if self.__push_results else None,
+            'pushed_layers': sum(r_.get('layers_pushed') or 0 for r_ in self.__push_results)
+            if self.__push_results else None,
+            'push_seconds': sum(r_.get('seconds') or 0 for r_ in self.__push_results) if self.__push_results else None,
+        }
+
+        os.makedirs(self.__directory, exist_ok=True)
+        with open(f'{self.__directory}{os.path.sep}builds.jsonl', 'a') as out_:
+            out_.write(f'{json.dumps(record)}\n')
+        text_file = f'{self.__directory}{os.path.sep}build{"-" + self.__job_id if self.__job_id else ""}.prom'
+        # Written aside and moved so a collector never reads half a file
+        with open(f'{text_file}.tmp', 'w') as out_:
+            out_.writelines(self.__to_openmetrics__(record))
+        os.replace(f'{text_file}.tmp', text_file)
+        logging.warning(f'Wrote metrics to {text_file}')
+        return record
+
+    @staticmethod
+    def __to_openmetrics__(record):
+        """
+        OpenMetrics text exposition of a build record, every metric is a gauge of the last build
+        :param record: dict
+        :return: list of lines
+        """
+        def labels_(extra_=None):
+            pairs = {'application': record.get('application')}
+            if record.get('job'):
+                pairs['matrix_job'] = record.get('job')
+            pairs.update(extra_ or {})
+            escaped = [f'{k_}="{MetricsHelper.__escape__(v_)}"' for k_, v_ in pairs.items()]
+            return '{' + ','.join(escaped) + '}'
+
+        families = [
+            ('dockerbuild_success', None, 'Whether the build succeeded',
+             [({}, int(record.get('succeeded')))]),
+            ('dockerbuild_reused', None, 'Whether an image with the same build hash was reused instead of building',
+             [({}, int(record.get('reused')))]),
+            ('dockerbuild_timestamp_seconds', 'seconds', 'When the build finished',
+             [({}, round(time.time(), 3))]),
+            ('dockerbuild_phase_seconds', 'seconds', 'Time each phase took',
+             [({'phase': p_}, s_) for p_, s_ in record.get('phases').items()]),
+            ('dockerbuild_build_seconds', 'seconds', 'Time the docker build took',
+             [({}, record.get('build_seconds'))]),
+            ('dockerbuild_step_seconds', 'seconds', 'Time each Dockerfile step took',
+             [({'step': s_.get('step'), 'stage': s_.get('stage') or '', 'items': ','.join(s_.get('items') or []),
+                'cached': str(bool(s_.get('cached'))).lower()}, s_.get('seconds'))
+              for s_ in record.get('step_seconds')]),
+            ('dockerbuild_steps', None, 'Steps that came from the layer cache and steps that ran',
+             [({'state': 'cached'}, record.get('steps').get('cached')),
+              ({'state': 'executed'}, record.get('steps').get('executed'))] if record.get('step_seconds') else []),
+            ('dockerbuild_cache_hit_ratio', 'ratio', 'Share of the steps that came from the layer cache',
+             [({}, record.get('steps').get('cache_hit_ratio'))]),
+            ('dockerbuild_context_bytes', 'bytes', 'Bytes of build context sent to docker',
+             [({}, record.get('context_bytes'))]),
+            ('dockerbuild_context_files', None, 'Files of build context sent to docker',
+             [({}, record.get('context_files'))]),
+            ('dockerbuild_image_size_bytes', 'bytes', 'Size of the built image',
+             [({}, record.get('image_size_bytes'))]),
+            ('dockerbuild_pushed_bytes', 'bytes', 'Bytes of layers pushed to the registry',
+             [({}, record.get('pushed_bytes'))]),
+            ('dockerbuild_pushed_layers', None, 'Layers pushed to the registry, the others already existed',
+             [({}, record.get('pushed_layers'))]),
+            ('dockerbuild_push_seconds', 'seconds', 'Time pushing to the registry took',
+             [({}, record.get('push_seconds'))]),
+        ]
+        lines = []
+        for name_, unit_, help_, samples_ in families:
+            samples_ = [(l_, v_) for l_, v_ in samples_ if v_ is not None]
+            if not samples_:
+                continue
+            lines.append(f'# TYPE {name_} gauge\n')
+            if unit_:
+                lines.append(f'# UNIT {name_} {unit_}\n')
+            lines.append(f'# HELP {name_} {help_}.\n')
+            lines.extend(f'{name_}{labels_(l_)} {v_}\n' for l_, v_ in samples_)
+        lines.append('# EOF\n')
+        return lines
+
+    @staticmethod
+    def __escape__(value_):
+        """
+        Escape a label value for the text exposition
+        :param value_: label value
+        :return: string
+        """
+        return str(value_).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class MultiBuildHelper:
+    """
+    Run the full multi stage build for one inputs file: generate, clone, set up ECR, build and upload.
+    Generating, cloning and setting up ECR do not depend on each other so they run at the same time.
+    """
+
+    __input_helper = None
+    __do_upload = False
+    __do_prune = False
+    __update_lock = False
+    __phase_timings = None
+
+    def __init__(self, input_helper, upload=False, prune=False, update_lock=False):
+        self.__input_helper = input_helper
+        self.__do_upload = upload
+        self.__do_prune = prune
+        self.__update_lock = update_lock
+
+    def run(self):
+        """
+        Build the image and optionally upload it
+        :return: string image_name
+        """
+        docker_build = DockerHelper(self.__input_helper)
+        git = GitHelper(self.__input_helper)
+        parents = None
+        phases = PhaseRunner('startup')
+        generate_requires = []
+        if strtobool(self.__input_helper.get_build_options('PIN_PARENTS', 'false')):
+            parents = ParentPinHelper(self.__input_helper, update=self.__update_lock)
+            phases.add('parents', lambda: self.__pin_parents__(docker_build, parents))
+            generate_requires.append('parents')
+        if docker_build.uses_artifact_store():
+            phases.add('commit', lambda: docker_build.set_git_commit(git.get_remote_commit()))
+            generate_requires.append('commit')
+        phases.add('generate', docker_build.create_multi_docker_file, requires=generate_requires)
+        # Only the artifact store makes the clone depend on what was generated
+        phases.add('clone', lambda: self.__clone__(docker_build, git),
+                   requires=['generate'] if docker_build.uses_artifact_store() else [])
+        phases.add('ecr', lambda: EcrHelper(self.__input_helper, prune=self.__do_prune))
+        metrics = MetricsHelper(self.__input_helper)
+        build_tag = None
+        try:
+            aws_ecr = phases.run().get('ecr')
+            self.__phase_timings = phases.get_timings()
+            metrics.add_phases(self.__phase_timings)
+            metrics.add_phases(aws_ecr.get_phase_timings(), prefix='ecr_')
+            docker_build.set_repository_uri(aws_ecr.get_repository_uri())
+            docker_build.set_application_version_next(aws_ecr.get_application_version_next())
+            docker_build.set_docker_env(aws_ecr.get_docker_env())
+            docker_build.set_network(aws_ecr.get_network())
+            docker_build.set_image_cache(aws_ecr.get_image_cache())
+            docker_build.set_git_commit(git.get_commit())
+            build_tag = metrics.timed('find_build', lambda: aws_ecr.registry_find_build(docker_build.get_build_hash()))
+            if build_tag:
+                logging.warning(f'Nothing changed, reusing {build_tag}')
+                metrics.set_build(docker_build, reused=True)
+            else:
+                if parents:
+                    metrics.timed('parents_pull', parents.wait)
+                # zstd layers can only be pushed by the build itself
+                push_from_build = self.__do_upload and docker_build.uses_zstd()
+                if push_from_build:
+                    aws_ecr.registry_login_cli()
+                build_tag = metrics.timed('build', lambda: docker_build.build_multi_docker_image(push=push_from_build))
+                metrics.set_build(docker_build)
+                if self.__do_upload:
+                    metrics.add_push(metrics.timed('push', lambda: aws_ecr.registry_upload(
+                        build_tag, pushed=docker_build.get_buildx_push())))
+        except BaseException:
+            metrics.add_phases(phases.get_timings())
+            metrics.set_build(docker_build)
+            metrics.write(build_tag, succeeded=False)
+            raise
+
+        metrics.write(build_tag, succeeded=True)
+        return build_tag
+
+    def generate(self):
+        """
+        Only generate the Dockerfile and stage the build context, without touching docker, ECR or
+        the remote repository. Parents are pinned from the lock file when PIN_PARENTS is set.
+        :return: list
+        """
+        docker_build = DockerHelper(self.__input_helper)
+        if strtobool(self.__input_helper.get_build_options('PIN_PARENTS', 'false')):
+            parents = ParentPinHelper(self.__input_helper)
+            docker_build.set_parent_pins(parents.pin(resolve=False))
+
+        return docker_build.create_multi_docker_file()
+
+    @staticmethod
+    def __pin_parents__(docker_build, parents):
+        """
+        Pin the parents for the generated Dockerfile and start pulling them
+        :param docker_build: DockerHelper
+        :param parents: ParentPinHelper
+        :return: dict
+        """
+        docker_build.set_parent_pins(parents.pin())
+        parents.pull()
+        return parents.get_pins()
+
+    @staticmethod
+    def __clone__(docker_build, git):
+        """
+        Clone the code unless the build stage was skipped for stored artifacts
+        :param docker_build: DockerHelper
+        :param git: GitHelper
+        :return: repo or None
+        """
+        if docker_build.has_stored_artifacts():
+            return None
+
+        return git.clone_git()
+
+    def get_phase_timings(self):
+        return self.__phase_timings
+
+
+class WatchHelper:
+    """
+    Keep docker, the ECR session and the network open and rebuild one image every time the inputs
+    file, a selected component folder or the cloned code is saved. Changes are debounced and a build
+    still running when a newer change arrives is cancelled.
+    """
+
+    __inputs_file_name = None
+    __image_type = None
+    __do_upload = False
+    __input_helper = None
+    __aws_ecr = None
+    __git = None
+    __parent_pins = None
+    __interval = None
+    __debounce = None
+    __docker_build = None
+    __build_thread = None
+    __folders = None
+
+    def __init__(self, inputs_file_name, image_type, upload=False, prune=False, clone=False, update_lock=False):
+        self.__inputs_file_name = inputs_file_name
+        self.__image_type = image_type
+        self.__do_upload = upload
+        self.__input_helper = InputHelper(inputs_file_name)
+        self.__interval = float(self.__input_helper.get_build_options('WATCH_INTERVAL', '0.5'))
+        self.__debounce = float(self.__input_helper.get_build_options('WATCH_DEBOUNCE', '1'))
+        self.__parent_pins = {}
+        if strtobool(self.__input_helper.get_build_options('PIN_PARENTS', 'false')):
+            parents = ParentPinHelper(self.__input_helper, update=update_lock)
+            self.__parent_pins = parents.pin()
+            parents.pull()
+            parents.wait()
+        self.__git = GitHelper(self.__input_helper)
+        if clone:
+            self.__git.clone_git()
+        self.__aws_ecr = EcrHelper(self.__input_helper, prune=prune)
+
+    def run(self):
+        """
+        Build once then keep rebuilding on changes until interrupted
+        :return: None
+        """
+        self.__rebuild__({'inputs'})
+        snapshot = self.__snapshot__()
+        logging.warning(f'Watching {self.__inputs_file_name}, {len(self.__folders or [])} component folders and '
+                        f'{self.__git.get_git_folder()}, press Ctrl+C to stop')
+        try:
+            while True:
+                time.sleep(self.__interval)
+                current = self.__snapshot__()
+                if current == snapshot:
+                    continue
+
+                # Wait for the saves to settle so one edit across several files is one rebuild
+                settled = current
+                while True:
+                    time.sleep(self.__debounce)
+                    current = self.__snapshot__()
+                    if current == settled:
+                        break
+                    settled = current
+
+                changed = self.__changed__(snapshot, current)
+                snapshot = current
+                self.__rebuild__(changed)
+                if 'inputs' in changed:
+                    snapshot = self.__snapshot__()
+        except KeyboardInterrupt:
+            logging.warning('Stopped watching')
+            if self.__docker_build:
+                self.__docker_build.cancel()
+
+    def __rebuild__(self, changed):
+        """
+        Cancel the build that is running, generate the Dockerfile again unless only the code changed
+        and start a new build
+        :param changed: set of what changed (inputs|items|code)
+        :return: None
+        """
+        if self.__build_thread and self.__build_thread.is_alive():
+            logging.warning(f'{", ".join(sorted(changed))} changed, cancelling the running build')
+            self.__docker_build.cancel()
+            # The next build uses the same directory and tag so the cancelled one has to be gone
+            self.__build_thread.join()
+
+        started = time.monotonic()
+        if 'inputs' in changed:
+            self.__input_helper = InputHelper(self.__inputs_file_name)
+        docker_build = DockerHelper(self.__input_helper)
+        docker_build.set_parent_pins(self.__parent_pins)
+        # When only the code changed the Dockerfile is the same, the catalog only rescans changed folders
+        if changed - {'code'}:
+            try:
+                docker_build.create_docker_file(self.__image_type)
+            except SystemExit as se:
+                logging.warning(f'Not building: {se}')
+                return
+            self.__folders = docker_build.get_item_folders(self.__image_type)
+        if self.__do_upload:
+            # Every upload needs a version of its own, the tags can be immutable
+            self.__aws_ecr.registry_get_latest()
+        docker_build.set_repository_uri(self.__aws_ecr.get_repository_uri())
+        docker_build.set_application_version_next(self.__aws_ecr.get_application_version_next())
+        docker_build.set_docker_env(self.__aws_ecr.get_docker_env())
+        docker_build.set_network(self.__aws_ecr.get_network())
+        docker_build.set_image_cache(self.__aws_ecr.get_image_cache())
+        logging.warning(f'Generated in {time.monotonic() - started:.2f}s, building')
+        self.__docker_build = docker_build
+        self.__build_thread = threading.Thread(target=self.__build__, args=(docker_build,), daemon=True)
+        self.__build_thread.start()
+
+    def __build__(self, docker_build):
+        """
+        Build and optionally upload, a failed or cancelled build is logged and the watch goes on
+        :param docker_build: DockerHelper
+        :return: string image_name or None
+        """
+        started = time.monotonic()
+        try:
+            push_from_build = self.__do_upload and docker_build.uses_zstd()
+            if push_from_build:
+                self.__aws_ecr.registry_login_cli()
+            build_tag = docker_build.build_docker_image(self.__image_type, push=push_from_build)
+            if self.__do_upload:
+                self.__aws_ecr.registry_upload(build_tag, pushed=docker_build.get_buildx_push())
+        except BuildCancelled as bc:
+            logging.warning(f'{bc}')
+            return None
+        except SystemExit as se:
+            logging.warning(f'Build failed, waiting for the next change: {se}')
+            return None
+
+        logging.warning(f'Rebuilt {build_tag} in {time.monotonic() - started:.1f}s')
+        return build_tag
+
+    def __snapshot__(self):
+        """
+        Modification time and size of every watched file, git metadata is skipped
+        :return: dict of path to (category, mtime, size)
+        """
+        snapshot = {}
+        if os.path.exists(self.__inputs_file_name):
+            stat_ = os.stat(self.__inputs_file_name)
+            snapshot[self.__inputs_file_name] = ('inputs', stat_.st_mtime_ns, stat_.st_size)
+        for category_, folder_ in [('items', f_) for f_ in self.__folders or []] + \
+                                 [('code', self.__git.get_git_folder())]:
+            for (root, dirs, files) in os.walk(folder_):
+                dirs[:] = [d_ for d_ in dirs if d_ != '.git']
+                for f_ in files:
+                    path_ = os.path.join(root, f_)
+                    try:
+                        stat_ = os.stat(path_)
+                    except FileNotFoundError:
+                        continue
+                    snapshot[path_] = (category_, stat_.st_mtime_ns, stat_.st_size)
+
+        return snapshot
+
+    @staticmethod
+    def __changed__(before, after):
+        """
+        What kind of files were added, removed or saved between two snapshots
+        :param before: dict
+        :param after: dict
+        :return: set of (inputs|items|code)
+        """
+        changed = set()
+        for path_ in set(before) | set(after):
+            if before.get(path_) != after.get(path_):
+                changed.add((after.get(path_) or before.get(path_))[0])
+
+        return changed
+
+
+class DockerHostPool:
+    """
+    Place builds on a pool of docker daemons. A job goes to a host that already has its layers warm,
+    either because it built the same parents and items during this run or because it holds the
+    parent images and earlier builds of the application, and otherwise to the least loaded host.
+    Each host runs at most jobs_per_host builds at a time.
+    """
+
+    __hosts = None
+    __jobs_per_host = None
+    __running = None
+    __warm = None
+    __condition = None
+    __clients = None
+    __clients_lock = None
+
+    def __init__(self, docker_hosts, jobs_per_host=2):
+        self.__hosts = docker_hosts
+        self.__jobs_per_host = jobs_per_host
+        self.__running = {host_: 0 for host_ in docker_hosts}
+        self.__warm = {host_: set() for host_ in docker_hosts}
+        self.__condition = threading.Condition()
+        self.__clients = {}
+        self.__clients_lock = threading.Lock()
+
+    @staticmethod
+    def connect(docker_host):
+        """
+        Client for a docker host, TLS settings still come from DOCKER_TLS_VERIFY and DOCKER_CERT_PATH
+        :param docker_host: string url, None for the one in the environment
+        :return: client
+        """
+        import docker
+
+        return docker.from_env(environment=DockerHostPool.environment(docker_host))
+
+    @staticmethod
+    def environment(docker_host):
+        """
+        Environment for docker cli commands that run against a docker host
+        :param docker_host: string url, None for the one in the environment
+        :return: dict
+        """
+        if docker_host:
+            return dict(os.environ, DOCKER_HOST=docker_host)
+
+        return dict(os.environ)
+
+    @staticmethod
+    def get_warm_key(input_helper):
+        """
+        Key of the layers a build reuses: its parents and selected items
+        :param input_helper: InputHelper
+        :return: string
+        """
+        return '|'.join([input_helper.get_application_build('PARENT_NAME'),
+                         input_helper.get_application_build('SELECTED_ITEMS').replace(' ', ''),
+                         input_helper.get_application_image('PARENT_NAME'),
+                         input_helper.get_application_image('SELECTED_ITEMS').replace(' ', '')])
+
+    def acquire(self, input_helper, exclude=None):
+        """
+        Wait for a free slot and take it on the best host for a job
+        :param input_helper: InputHelper of the job
+        :param exclude: list of hosts the job already failed on
+        :return: string host or None when no host is left to try
+        """
+        warm_key = self.get_warm_key(input_helper)
+        parents = {input_helper.get_application_build('PARENT_NAME'), input_helper.get_application_image('PARENT_NAME')}
+        application_name = input_helper.get_application('NAME')
+        while True:
+            candidates = [h_ for h_ in self.__hosts if h_ not in (exclude or [])]
+            probes = {h_: self.__probe__(h_, parents, application_name) for h_ in candidates}
+            candidates = [h_ for h_ in candidates if probes.get(h_) is not None]
+            if not candidates:
+                return None
+
+            with self.__condition:
+                free = [h_ for h_ in candidates if self.__running[h_] < self.__jobs_per_host]
+                if free:
+                    host = min(free, key=lambda h_: (-(2 * (warm_key in self.__warm[h_]) + probes[h_][0]),
+                                                     self.__running[h_] + probes[h_][1],
+                                                     self.__hosts.index(h_)))
+                    self.__running[host] += 1
+                    logging.warning(f'Placing {application_name} on {host}, {self.__running[host]} jobs running '
+                                    f'there{", layers warm" if warm_key in self.__warm[host] or probes[host][0] else ""}')
+                    return host
+                self.__condition.wait(timeout=30)
+
+    def get_hosts(self):
+        return self.__hosts
+
+    def get_client(self, docker_host):
+        """
+        The one client the pool keeps for a host, used to probe it between jobs
+        :param docker_host: string
+        :return: client
+        """
+        with self.__clients_lock:
+            if docker_host not in self.__clients:
+                self.__clients[docker_host] = self.connect(docker_host)
+            return self.__clients[docker_host]
+
+    def close(self):
+        """
+        Close the clients the pool kept
+        :return: None
+        """
+        with self.__clients_lock:
+            for client_ in self.__clients.values():
+                client_.close()
+            self.__clients = {}
+
+    def release(self, docker_host, input_helper, succeeded):
+        """
+        Free the slot of a finished job, a successful build leaves its layers warm on the host
+        :param docker_host: string
+        :param input_helper: InputHelper of the job
+        :param succeeded: bool
+        :return: None
+        """
+        with self.__condition:
+            self.__running[docker_host] -= 1
+            if succeeded:
+                self.__warm[docker_host].add(self.get_warm_key(input_helper))
+            self.__condition.notify_all()
+
+    def __probe__(self, docker_host, parents, application_name):
+        """
+        Ask a host how warm it is for a job and how busy it is
+        :param docker_host: string
+        :param parents: set of parent names
+        :param application_name: string
+        :return: tuple of warm score and running containers, None when the host cannot be reached
+        """
+        from docker.errors import DockerException, ImageNotFound
+        from requests.exceptions import RequestException
+
+        try:
+            docker_env = self.get_client(docker_host)
+            warm = 0
+            for parent_ in parents:
+                try:
+                    docker_env.images.get(parent_)
+                    warm += 1
+                except ImageNotFound:
+                    pass
+            if docker_env.images.list(filters={'label': f'Application={application_name}'}):
+                warm += 1
+            return warm, docker_env.info().get('ContainersRunning', 0)
+        except (DockerException, RequestException) as de:
+            # A cached client to a host that went down raises the errors of requests
+            logging.warning(f'Skipping {docker_host}: {de}')
+            # Connect again the next time in case the host comes back
+            with self.__clients_lock:
+                client = self.__clients.pop(docker_host, None)
+            if client:
+                client.close()
+            return None
+
+
+class MatrixHelper:
+    """
+    Build several inputs files at the same time on a pool of workers.
+    Each job gets its own build directories and network so they do not interfere.
+    With docker hosts the jobs are spread over them and a failed job is tried again on another host.
+    """
+
+    __inputs_files = None
+    __max_workers = None
+    __do_upload = False
+    __host_pool = None
+    __host_retries = None
+
+    def __init__(self, inputs_files, max_workers=2, upload=False, docker_hosts=None, jobs_per_host=2,
+                 host_retries=1):
+        self.__inputs_files = inputs_files
+        self.__max_workers = max_workers
+        self.__do_upload = upload
+        self.__host_retries = host_retries
+        if docker_hosts:
+            self.__host_pool = DockerHostPool(docker_hosts, jobs_per_host=jobs_per_host)
+
+    @staticmethod
+    def get_job_id(inputs_file_name):
+        """
+        Job id from the inputs file name with anything docker will not accept in a name replaced
+        :param inputs_file_name: string
+        :return: string
+        """
+        base_name_ = os.path.splitext(os.path.basename(inputs_file_name))[0]
+        return ''.join(c_ if c_.isalnum() or c_ in '_.-' else '_' for c_ in base_name_)
+
+    def run(self):
+        """
+        Build every inputs file and wait for all of them
+        :return: dict of inputs file to image_name, None when the job failed
+        """
+        job_ids = [self.get_job_id(f_) for f_ in self.__inputs_files]
+        if len(set(job_ids)) != len(job_ids):
+            sys.exit(f'Inputs files must have unique names: {self.__inputs_files}')
+
+        self.__evict__()
+        results = {}
+        logging.warning(f'Building {len(self.__inputs_files)} inputs with {self.__max_workers} workers')
+        with ThreadPoolExecutor(max_workers=self.__max_workers, thread_name_prefix='matrix') as executor:
+            futures = {}
+            for inputs_file_, job_id_ in zip(self.__inputs_files, job_ids):
+                if self.__host_pool:
+                    futures[inputs_file_] = executor.submit(self.__run_on_hosts__, inputs_file_, job_id_)
+                else:
+                    input_helper = InputHelper(inputs_file_, job_id=job_id_)
+                    futures[inputs_file_] = executor.submit(MultiBuildHelper(input_helper,
+                                                                             upload=self.__do_upload).run)
+
+            for inputs_file_, future_ in futures.items():
+                try:
+                    results[inputs_file_] = future_.result()
+                    logging.warning(f'{inputs_file_} built {results[inputs_file_]}')
+                except BaseException as be:
+                    results[inputs_file_] = None
+                    logging.warning(f'{inputs_file_} failed: {be}')
+
+        if self.__host_pool:
+            self.__host_pool.close()
+        return results
+
+    def __evict__(self):
+        """
+        Evict the least recently used images once on every docker host before any job starts, jobs
+        do not evict themselves as they could remove images the other builds are about to reuse
+        :return: None
+        """
+        from docker.errors import DockerException
+        from requests.exceptions import RequestException
+
+        for docker_host_ in self.__host_pool.get_hosts() if self.__host_pool else [None]:
+            input_helper = InputHelper(self.__inputs_files[0], docker_host=docker_host_)
+            try:
+                if self.__host_pool:
+                    ImageCacheHelper(input_helper, self.__host_pool.get_client(docker_host_)).evict()
+                else:
+                    docker_env = DockerHostPool.connect(docker_host_)
+                    ImageCacheHelper(input_helper, docker_env).evict()
+                    docker_env.close()
+            except (DockerException, RequestException) as de:
+                logging.warning(f'Could not evict images on {docker_host_ or "the local docker"}: {de}')
+
+    def __run_on_hosts__(self, inputs_file, job_id):
+        """
+        Build one inputs file on the host the pool picks, trying other hosts when it fails
+        :param inputs_file: string
+        :param job_id: string
+        :return: string image_name
+        """
+        failed_hosts = []
+        while True:
+            input_helper = InputHelper(inputs_file, job_id=job_id)
+            docker_host = self.__host_pool.acquire(input_helper, exclude=failed_hosts)
+            if docker_host is None:
+                sys.exit(f'{inputs_file} failed on {failed_hosts} and no other docker host is left')
+
+            succeeded = False
+            try:
+                build_tag = MultiBuildHelper(InputHelper(inputs_file, job_id=job_id, docker_host=docker_host),
+                                             upload=self.__do_upload).run()
+                succeeded = True
+                return build_tag
+            except (Exception, SystemExit) as be:
+                failed_hosts.append(docker_host)
+                if len(failed_hosts) > self.__host_retries:
+                    raise
+                logging.warning(f'{inputs_file} failed on {docker_host}, trying another host: {be}')
+            finally:
+                self.__host_pool.release(docker_host, input_helper, succeeded)